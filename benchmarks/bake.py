@@ -0,0 +1,63 @@
+"""
+Compares calling an injected function, before and after baking it, with
+calling an undecorated function.
+
+    python benchmarks/bake.py
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import timeit
+
+from di import injector, DependencyMap
+
+
+class Config(object):
+    pass
+
+
+class Redis(object):
+    pass
+
+
+dm = DependencyMap()
+dm[Config] = Config()
+
+
+@dm.singleton(Redis)
+def redis_factory(deps):
+    return Redis()
+
+
+inject = injector(dm)
+
+
+def plain(request, config=dm[Config], redis=dm[Redis]):
+    return request
+
+
+@inject
+def injected(request, config=Config, redis=Redis):
+    return request
+
+
+NUMBER = 1000000
+
+
+def bench(label, stmt):
+    elapsed = min(timeit.repeat(stmt, globals=globals(), number=NUMBER, repeat=5))
+    print('{0:<28} {1:8.1f} ns/call'.format(label, elapsed / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    wrapper = injected
+
+    bench('undecorated', 'plain(1)')
+    bench('injected', 'injected(1)')
+    inject.bake()
+    # Baking rebinds the module global to the original function
+    bench('baked (module function)', 'injected(1)')
+    bench('baked (wrapper reference)', 'wrapper(1)')
+    inject.unbake()
@@ -0,0 +1,88 @@
+"""
+Reports the memory used by forked workers when a large singleton is built
+lazily in each one of them versus preloading it in the parent process with
+`DependencyMap.preload_for_fork()`. Linux only, it reads /proc/<pid>/smaps.
+
+    python benchmarks/fork_memory.py [workers] [entries]
+
+USS is the memory private to a worker, PSS also accounts for its share of
+the pages shared with the parent and the other workers.
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+from di import DependencyMap
+
+LOOKUP = 'lookup'
+
+
+def memory_usage():
+    """ Returns the (uss, pss) of the current process in KiB """
+    uss = pss = 0
+    with open('/proc/self/smaps_rollup') as fd:
+        for line in fd:
+            field, value = line.split(':', 1)
+            if field in ('Private_Clean', 'Private_Dirty'):
+                uss += int(value.split()[0])
+            elif field == 'Pss':
+                pss += int(value.split()[0])
+    return uss, pss
+
+
+def build_map(entries):
+    dm = DependencyMap()
+
+    @dm.singleton(LOOKUP, fork_safe=True)
+    def lookup(deps):
+        return dict(('key-{0}'.format(i), ('value', i)) for i in range(entries))
+
+    return dm
+
+
+def run(dm, workers, preload):
+    if preload:
+        dm.preload_for_fork()
+
+    pipes = []
+    for _ in range(workers):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            # Simulate a worker reading the whole dependency
+            lookup = dm[LOOKUP]
+            sum(value[1] for value in lookup.values())
+            os.write(wfd, '{0} {1}'.format(*memory_usage()).encode('ascii'))
+            os._exit(0)
+        os.close(wfd)
+        pipes.append((pid, rfd))
+
+    results = []
+    for pid, rfd in pipes:
+        results.append([int(x) for x in os.read(rfd, 64).split()])
+        os.close(rfd)
+        os.waitpid(pid, 0)
+
+    uss = sum(r[0] for r in results) / len(results) / 1024.0
+    pss = sum(r[1] for r in results) / len(results) / 1024.0
+    print('{0:<8} workers={1} avg USS={2:8.1f} MiB avg PSS={3:8.1f} MiB'.format(
+        'preload' if preload else 'lazy', workers, uss, pss))
+
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    entries = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+
+    # Each mode runs in its own process so the measures don't interfere
+    for preload in (False, True):
+        pid = os.fork()
+        if pid == 0:
+            run(build_map(entries), workers, preload)
+            sys.stdout.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
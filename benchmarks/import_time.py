@@ -0,0 +1,68 @@
+"""
+Measures the import time of a module with thousands of decorated functions,
+comparing eager inspection with the lazy mode of the injector.
+
+    python benchmarks/import_time.py [functions]
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+TEMPLATE = '''
+@inject
+def handler_{0}(request, config=Config, redis=Redis):
+    return request
+'''
+
+HEADER = '''
+from di import injector, DependencyMap
+
+class Config(object): pass
+class Redis(object): pass
+
+inject = injector(DependencyMap(), lazy={0})
+'''
+
+# Measure in a fresh interpreter so nothing is cached between runs
+RUNNER = '''
+import sys, time
+sys.path.insert(0, {0!r})
+start = time.time()
+import {1}
+print(time.time() - start)
+'''
+
+
+def measure(path, module):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root, PYTHONDONTWRITEBYTECODE='1')
+    out = subprocess.check_output([sys.executable, '-c', RUNNER.format(path, module)], env=env)
+    return float(out)
+
+
+def main(count):
+    path = tempfile.mkdtemp()
+    try:
+        for lazy in (False, True):
+            module = 'handlers_{0}'.format('lazy' if lazy else 'eager')
+            with open(os.path.join(path, module + '.py'), 'w') as fd:
+                fd.write(HEADER.format(lazy))
+                for i in range(count):
+                    fd.write(TEMPLATE.format(i))
+
+            best = min(measure(path, module) for _ in range(5))
+            print('{0:<6} {1} functions: {2:8.1f} ms'.format(
+                'lazy' if lazy else 'eager', count, best * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -0,0 +1,62 @@
+"""
+Measures the memory used by a dependency map with thousands of keys and the
+time to resolve plain values, singletons and `Key` wrapped dependencies.
+
+    python benchmarks/map_size.py [keys]
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import sys
+import timeit
+import tracemalloc
+
+from di import DependencyMap, Key
+
+NUMBER = 200000
+
+
+def build_map(count):
+    dm = DependencyMap()
+    for i in range(count):
+        if i % 2:
+            dm.register('value-{0}'.format(i), i)
+        else:
+            dm.singleton('singleton-{0}'.format(i))(lambda deps: object())
+    return dm
+
+
+def bench(label, stmt, namespace):
+    elapsed = min(timeit.repeat(stmt, globals=namespace, number=NUMBER, repeat=5))
+    print('{0:<20} {1:8.1f} ns/lookup'.format(label, elapsed / NUMBER * 1e9))
+
+
+def main(count):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    dm = build_map(count)
+    for i in range(0, count, 2):
+        dm['singleton-{0}'.format(i)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print('{0} keys: {1:8.1f} KiB ({2:.0f} bytes/key)'.format(count, size / 1024.0, size / float(count)))
+
+    namespace = {
+        'dm': dm,
+        'Key': Key,
+        'value': 'value-{0}'.format(count - 1),
+        'singleton': 'singleton-{0}'.format(count - 2),
+        'key': Key('singleton-{0}'.format(count - 2)),
+    }
+    bench('value', 'dm[value]', namespace)
+    bench('singleton', 'dm[singleton]', namespace)
+    bench('Key', 'dm[key]', namespace)
+    bench('Key (new)', 'dm[Key(singleton)]', namespace)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,44 @@
+"""
+Compares attribute access through InjectorProxy against a direct reference.
+
+    python benchmarks/proxy.py
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import timeit
+
+from di import DependencyMap
+
+
+class Redis(object):
+    def __init__(self):
+        self.host = '127.0.0.1'
+
+
+dm = DependencyMap()
+
+
+@dm.singleton(Redis)
+def redis_factory(deps):
+    return Redis()
+
+
+direct = dm[Redis]
+proxy = dm.proxy(Redis)
+bound = dm.proxy(Redis, bind=True)
+
+NUMBER = 1000000
+
+
+def bench(label, stmt):
+    elapsed = min(timeit.repeat(stmt, globals=globals(), number=NUMBER, repeat=5))
+    print('{0:<20} {1:8.1f} ns/access'.format(label, elapsed / NUMBER * 1e9))
+
+
+if __name__ == '__main__':
+    bench('direct', 'direct.host')
+    bench('proxy', 'proxy.host')
+    bench('proxy (bind=True)', 'bound.host')
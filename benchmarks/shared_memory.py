@@ -0,0 +1,102 @@
+"""
+Compares building a large read only dependency in every process with placing
+it in shared memory using `DependencyMap.shared`. Every worker starts with a
+fresh dependency map, as unrelated processes would. Linux only, memory is
+read from /proc/self/smaps_rollup.
+
+    python benchmarks/shared_memory.py [workers] [megabytes]
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import array
+import hashlib
+
+from di import DependencyMap
+from di.main import timer
+
+TABLE = 'table'
+
+
+def memory_usage():
+    """ Returns the (uss, pss) of the current process in KiB """
+    uss = pss = 0
+    with open('/proc/self/smaps_rollup') as fd:
+        for line in fd:
+            field, value = line.split(':', 1)
+            if field in ('Private_Clean', 'Private_Dirty'):
+                uss += int(value.split()[0])
+            elif field == 'Pss':
+                pss += int(value.split()[0])
+    return uss, pss
+
+
+def build_table(megabytes):
+    # Simulate an expensive factory, i.e. computing an embeddings table
+    return array.array('d', (i * 0.5 for i in range(megabytes * 1024 * 128)))
+
+
+def worker(shared, megabytes, wfd, release):
+    dm = DependencyMap()
+    if shared:
+        dm.shared(TABLE, name='di_bench_{0}'.format(os.getppid()))(lambda deps: build_table(megabytes))
+    else:
+        dm.singleton(TABLE)(lambda deps: build_table(megabytes))
+
+    start = timer()
+    table = dm[TABLE]
+    elapsed = timer() - start
+
+    # Read the whole table as a real worker would
+    hashlib.md5(memoryview(table)).digest()
+    uss, pss = memory_usage()
+    os.write(wfd, '{0} {1} {2}'.format(elapsed, uss, pss).encode('ascii'))
+
+    # The first worker owns the segment, keep it alive until all are done
+    os.read(release, 1)
+    del table
+    dm.close_shared()
+
+
+def run(shared, workers, megabytes):
+    release, release_w = os.pipe()
+    pipes = []
+    for _ in range(workers):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            os.close(release_w)
+            worker(shared, megabytes, wfd, release)
+            os._exit(0)
+        os.close(wfd)
+        # Workers are started one after the other, like a rolling restart
+        results = os.read(rfd, 128)
+        pipes.append((pid, rfd, [float(x) for x in results.split()]))
+
+    os.close(release_w)
+    for pid, rfd, _ in pipes:
+        os.close(rfd)
+        os.waitpid(pid, 0)
+
+    print('{0:<12} workers={1}'.format('shared' if shared else 'per-process', workers))
+    for i, (_, _, (elapsed, uss, pss)) in enumerate(pipes):
+        print('  worker {0}: startup={1:7.1f} ms USS={2:7.1f} MiB PSS={3:7.1f} MiB'.format(
+            i, elapsed * 1000, uss / 1024.0, pss / 1024.0))
+
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    for shared in (False, True):
+        pid = os.fork()
+        if pid == 0:
+            run(shared, workers, megabytes)
+            sys.stdout.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
@@ -0,0 +1,71 @@
+"""
+Measures the throughput of injected calls resolving a plain value, a
+singleton and a thread scoped dependency from 1 to 32 threads. Run it with a
+free-threaded build (python3.13t) to see how it scales without the GIL.
+
+    python benchmarks/threads.py [calls per thread]
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+"""
+from __future__ import print_function
+
+import sys
+import threading
+
+from di import DependencyMap, injector
+from di.main import timer
+
+
+class Config(object):
+    pass
+
+
+class Redis(object):
+    pass
+
+
+class Session(object):
+    pass
+
+
+dm = DependencyMap({Config: Config()})
+dm.singleton(Redis)(lambda deps: Redis())
+dm.thread(Session)(lambda deps: Session())
+
+inject = injector(dm)
+
+
+@inject
+def handler(request, config=Config, redis=Redis, session=Session):
+    return request
+
+
+def worker(calls, barrier):
+    barrier.wait()
+    for i in range(calls):
+        handler(i)
+
+
+def run(threads, calls):
+    barrier = threading.Barrier(threads + 1)
+    pool = [threading.Thread(target=worker, args=(calls, barrier)) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    start = timer()
+    for t in pool:
+        t.join()
+    return threads * calls / (timer() - start)
+
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('GIL enabled' if gil else 'GIL disabled')
+
+    base = None
+    for threads in (1, 2, 4, 8, 16, 32):
+        throughput = run(threads, calls)
+        base = base or throughput
+        print('{0:>2} threads: {1:10.0f} calls/s ({2:4.1f}x)'.format(threads, throughput, throughput / base))
@@ -4,11 +4,14 @@
 """
 
 from .main import (
-    Key, injector, InjectorDescriptor, MetaInject,
-    DependencyMap, ContextualDependencyMap, PatchedDependencyMap,
-    InjectorProxy
+    Key, injector, resolution_session, MetadataCache, InjectorDescriptor, MetaInject, inject_class,
+    ResolutionCache, DependencyMap, DependencyMapSpec, ContextualDependencyMap, PatchedDependencyMap,
+    InjectorProxy, LazyFactory, PersistentFactory, EventSampler, enable_events, disable_events,
+    dependency_scope, DependencyScope, ScopeRequired
 )
 
-__all__ = ['Key', 'injector', 'InjectorDescriptor', 'MetaInject',
-           'DependencyMap', 'ContextualDependencyMap', 'PatchedDependencyMap',
-           'InjectorProxy']
+__all__ = ['Key', 'injector', 'resolution_session', 'MetadataCache', 'InjectorDescriptor', 'MetaInject',
+           'inject_class', 'ResolutionCache', 'DependencyMap', 'DependencyMapSpec', 'ContextualDependencyMap',
+           'PatchedDependencyMap', 'InjectorProxy', 'LazyFactory', 'PersistentFactory',
+           'EventSampler', 'enable_events', 'disable_events', 'dependency_scope', 'DependencyScope',
+           'ScopeRequired']
@@ -0,0 +1,85 @@
+"""
+Integration with concurrent.futures process pools
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+
+Dependency maps can't be sent to other processes, factories are closures
+and the instances they build (connections, pools...) are not picklable. This
+module provides an executor which rebuilds the dependency map once in every
+worker from its spec and re-binds the injected functions submitted to it.
+
+    from di.futures import InjectorPoolExecutor
+
+    with InjectorPoolExecutor(dm, max_workers=8) as executor:
+        results = executor.map(compute_price, skus)
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+from .main import DependencyMapSpec, logger
+
+# Dependency map built for the current worker process
+_worker_map = None
+# Injectors already re-bound to the worker's dependency map
+_bound_injectors = set()
+
+
+def _initialize_worker(spec, initializer, initargs):
+    global _worker_map
+    _worker_map = spec.build()
+    logger.debug('Built dependency map for process pool worker')
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def get_worker_map():
+    """ Returns the dependency map built for the current worker, or None when
+        not running in a worker of an `InjectorPoolExecutor`.
+    """
+    return _worker_map
+
+
+class InjectedCall(object):
+    """ Picklable call to an injected function, which is re-bound to the
+        worker's dependency map before calling it.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        inject = self.fn.__injector__
+        if _worker_map is not None and id(inject) not in _bound_injectors:
+            inject.patch(_worker_map)
+            _bound_injectors.add(id(inject))
+        return self.fn(*args, **kwargs)
+
+
+class InjectorPoolExecutor(ProcessPoolExecutor):
+    """ Process pool executor which builds the given dependency map (or its
+        spec) once in each worker process. Injected functions submitted to it
+        are re-bound to the worker's map, regardless of the dependencies of
+        their injector in the submitting process.
+
+        Functions are sent to the workers by reference, so they must be
+        defined at module level, as it happens with any process pool.
+    """
+
+    def __init__(self, dependencies, max_workers=None, initializer=None, initargs=(), **kwargs):
+        spec = dependencies if isinstance(dependencies, DependencyMapSpec) else dependencies.spec()
+        super(InjectorPoolExecutor, self).__init__(
+            max_workers=max_workers,
+            initializer=_initialize_worker,
+            initargs=(spec, initializer, initargs),
+            **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        if hasattr(fn, '__injector__'):
+            fn = InjectedCall(fn)
+        return super(InjectorPoolExecutor, self).submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables, **kwargs):
+        # The process pool submits the function wrapped to process chunks
+        if hasattr(fn, '__injector__'):
+            fn = InjectedCall(fn)
+        return super(InjectorPoolExecutor, self).map(fn, *iterables, **kwargs)
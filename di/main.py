@@ -16,12 +16,26 @@ It doesn't form a *framework* but just a set of utilities to keep the dependency
 injection needs in a project under control by applying it only where it makes
 sense, with minimum overhead and a lean learning curve.
 """
+import gc
+import os
 import sys
+import mmap
+import time
+import pickle
+import zlib
+import struct
+import hashlib
+import atexit
+import marshal
+import weakref
 import logging
 import warnings
 import types
 import inspect
 import functools
+import importlib
+import itertools
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 
 import threading
@@ -31,10 +45,145 @@ except ImportError:
     # Python 3.3 exposes .get_ident on the threading module
     thread = threading
 
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7 lacks context variables, emulate them with thread locals
+    # which gives isolation per thread (although not per task)
+    class ContextVar(object):
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+            self._local = threading.local()
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            self._local.value = value
+
+try:
+    import typing
+except ImportError:
+    # Python 2 lacks type hints
+    typing = None
+
 PY2 = sys.version_info[0] == 2
 
+if PY2:
+    string_types = basestring  # noqa
+else:
+    string_types = str
+
+# Best clock available to measure durations
+timer = getattr(time, 'perf_counter', time.time)
+
+# Maps with process scoped dependencies, to dispose them before forking
+_process_maps = weakref.WeakSet()
+# Every map, to reset their locks after forking
+_all_maps = weakref.WeakSet()
+# Keep track of the current process id on fork, so checking it is cheap
+_pid = [os.getpid()]
+
+
+def _before_fork():
+    for depsmap in list(_process_maps):
+        depsmap._dispose_processes()
+
+
+def _after_fork_in_child():
+    _pid[0] = os.getpid()
+    # Locks held by other threads of the parent would never be released
+    for depsmap in list(_all_maps):
+        depsmap._reset_locks()
+
+
+# Header of the shared memory segments: (size, ready, creator pid)
+_SEGMENT_HEADER = struct.Struct('QQQ')
+# Seconds to wait for another process to fill a shared memory segment, it's
+# considered abandoned afterwards
+SEGMENT_TIMEOUT = 60
+
+
+def _open_segment(name, create=False, size=0):
+    """ Creates or attaches a shared memory segment without tracking it, its
+        lifecycle is managed by the dependency map that created it.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # Python < 3.13 always tracks the segment, which would be unlinked
+        # as soon as any process attached to it exits
+        segment = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def _unlink_segment(segment):
+    if getattr(segment, '_track', True):
+        # Python < 3.13 unregisters the segment when unlinking it
+        from multiprocessing import resource_tracker
+        resource_tracker.register(segment._name, 'shared_memory')
+    segment.unlink()
+
+
+def _discard_segment(name):
+    """ Unlinks an abandoned segment by its name, it may not even be sized """
+    logger.warning('Discarding abandoned shared memory segment %s', name)
+    try:
+        import _posixshmem
+    except ImportError:
+        # Windows releases it once every process closes it
+        return
+    try:
+        _posixshmem.shm_unlink('/' + name)
+    except FileNotFoundError:
+        # Discarded by another process
+        pass
+
+
+def _is_running(pid):
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _wait_segment(segment):
+    """ Waits until the creator of the segment has filled it, returns the
+        size of its data or None if the creator exited (or timed out) before.
+    """
+    deadline = timer() + SEGMENT_TIMEOUT
+    while True:
+        size, ready, pid = _SEGMENT_HEADER.unpack_from(segment.buf, 0)
+        if ready:
+            return size
+        if (pid and not _is_running(pid)) or timer() > deadline:
+            return None
+        time.sleep(0.01)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_in_child)
+
+    def _get_pid():
+        return _pid[0]
+else:
+    # Without fork hooks the process id must be checked every time
+    _get_pid = os.getpid
+
 logger = logging.getLogger(__name__)
 
+# Mutation versions are unique among all the maps, so a version identifies
+# the state of a specific map (i.e. the active one in a contextual map)
+_versions = itertools.count(1)
+
 
 class Key(object):
     """ Wraps a value to be used as key with the injector decorator.
@@ -50,25 +199,55 @@ class Key(object):
             @inject
             def foo(msg=Key('foo')):
                 print msg
+
+        Keys are interned, wrapping the same value returns the same instance.
     """
-    def __init__(self, value, *values):
+    __slots__ = ('value', '_hash', '__weakref__')
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, value, *values):
         if len(values):
-            self.value = (value,) + values
+            value = (value,) + values
+
+        # Equal values of different types (1, 1.0, True) get their own keys
+        # so the wrapped value keeps the type it was given
+        interned = (cls, type(value), value)
+        try:
+            key = cls._interned.get(interned)
+        except TypeError:
+            # Unhashable values can't be interned (nor used to look up a map)
+            key = None
+        if key is not None:
+            return key
+
+        key = super(Key, cls).__new__(cls)
+        key.value = value
+        try:
+            key._hash = hash(value)
+        except TypeError:
+            key._hash = None
         else:
-            self.value = value
+            cls._interned[interned] = key
+        return key
+
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
 
     def __hash__(self):
-        return hash(self.value)
+        if self._hash is None:
+            return hash(self.value)
+        return self._hash
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if isinstance(other, Key):
             return self.value == other.value
         return self.value == other
 
     def __ne__(self, other):
-        if isinstance(other, Key):
-            return self.value != other.value
-        return self.value != other
+        return not self == other
 
 
 def get_callable_defaults(fn, follow_wrapped=False):
@@ -101,7 +280,425 @@ def get_callable_defaults(fn, follow_wrapped=False):
     return defaults
 
 
-def injector(dependencies, warn=True, follow_wrapped=False):
+def get_injectables(fn, follow_wrapped=False):
+    """ Helper function to extract a map of name:dependency for the params
+        of a function that can be injected (classes or Key used as default).
+    """
+    mapping = {}
+    defaults = get_callable_defaults(fn, follow_wrapped=follow_wrapped)
+    for name, default in defaults.items():
+        if isinstance(default, Key):
+            mapping[name] = default.value
+        elif inspect.isclass(default):
+            mapping[name] = default
+    return mapping
+
+
+# Resolved type hints of the functions inspected so far
+_type_hints = weakref.WeakKeyDictionary()
+
+
+def get_type_hints(fn):
+    """ Helper function to obtain the type hints of a function, resolving
+        them is expensive so they are cached.
+    """
+    fn = getattr(fn, '__func__', fn)
+    try:
+        return _type_hints[fn]
+    except (KeyError, TypeError):
+        pass
+
+    try:
+        hints = typing.get_type_hints(fn)
+    except Exception:
+        # Forward references that can't be resolved are kept as is
+        hints = dict(getattr(fn, '__annotations__', None) or {})
+
+    try:
+        _type_hints[fn] = hints
+    except TypeError:
+        pass
+    return hints
+
+
+def get_init_params(cls):
+    """ Helper function to extract the params of the constructor of a class
+        as (name, default) tuples, using `Key` when there is no default.
+    """
+    init = cls.__init__
+    try: # PY35
+        sign = inspect.signature(init)
+        return [
+            (p.name, Key if p.default is p.empty else p.default)
+            for p in list(sign.parameters.values())[1:]
+            if p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD)
+        ]
+    except AttributeError: # PY2
+        try:
+            args, _, _, defaults = inspect.getargspec(init)
+        except TypeError:
+            # Builtin constructor like object's
+            return []
+        defaults = defaults or ()
+        return [
+            (name, Key) for name in args[1:len(args) - len(defaults)]
+        ] + list(zip(args[len(args) - len(defaults):], defaults))
+    except ValueError:
+        return []
+
+
+class MetadataCache(object):
+    """ Persists the layout of the params with defaults of decorated functions
+        in a directory, one file per module like __pycache__ does, so later
+        process starts can find the injectable params without inspecting the
+        function signatures.
+
+        Entries are keyed by the qualified name of the function and validated
+        with a checksum of its code object. Since the actual default values
+        are not part of the code object they are always read from the live
+        function, so changing a default does not need a new entry.
+    """
+
+    # Shared instances per directory so several injectors don't overwrite
+    # each other's entries
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._modules = {}
+        self._dirty = set()
+        atexit.register(self.save)
+
+    @classmethod
+    def for_path(cls, path):
+        path = os.path.abspath(path)
+        with cls._lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def get_injectables(self, fn, follow_wrapped=False):
+        """ Drop in replacement for the `get_injectables` helper function """
+        code = getattr(fn, '__code__', None)
+        if follow_wrapped or code is None or hasattr(fn, '__signature__'):
+            return get_injectables(fn, follow_wrapped=follow_wrapped)
+
+        module = fn.__module__
+        name = getattr(fn, '__qualname__', fn.__name__)
+        entries = self._load(module)
+        checksum = self._checksum(code)
+
+        entry = entries.get(name)
+        if entry and entry[0] == checksum:
+            mapping = self._rebuild(fn, entry[1])
+            if mapping is not None:
+                return mapping
+
+        mapping = get_injectables(fn)
+        entries[name] = (checksum, self._layout(fn))
+        self._dirty.add(module)
+        return mapping
+
+    def save(self):
+        """ Writes the modules with new entries, it's automatically called
+            when the process exits.
+        """
+        while self._dirty:
+            module = self._dirty.pop()
+            filename = self._filename(module)
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                # Write to a temporary file first so other processes never
+                # load a partially written cache
+                tmpname = '{0}.{1}'.format(filename, os.getpid())
+                with open(tmpname, 'wb') as fd:
+                    marshal.dump(self._modules[module], fd)
+                getattr(os, 'replace', os.rename)(tmpname, filename)
+            except (IOError, OSError) as ex:
+                logger.warning('Unable to write injection metadata cache %s: %s', filename, ex)
+
+    def _filename(self, module):
+        impl = getattr(sys, 'implementation', None)
+        tag = impl.cache_tag if impl else 'py{0}{1}'.format(*sys.version_info)
+        return os.path.join(self.path, '{0}.{1}.di'.format(module, tag))
+
+    def _load(self, module):
+        if module not in self._modules:
+            entries = {}
+            try:
+                with open(self._filename(module), 'rb') as fd:
+                    entries = marshal.load(fd)
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                pass
+            self._modules[module] = entries if isinstance(entries, dict) else {}
+        return self._modules[module]
+
+    @staticmethod
+    def _checksum(code):
+        signature = '{0}:{1}:{2}'.format(
+            code.co_argcount, getattr(code, 'co_kwonlyargcount', 0), code.co_varnames)
+        return zlib.crc32(code.co_code, zlib.crc32(signature.encode('utf-8'))) & 0xffffffff
+
+    @staticmethod
+    def _layout(fn):
+        """ Where the default of every param can be found: an index into
+            __defaults__ or a name into __kwdefaults__
+        """
+        code = fn.__code__
+        defaults = fn.__defaults__ or ()
+        argnames = code.co_varnames[:code.co_argcount]
+        offset = len(argnames) - len(defaults)
+        layout = tuple((argnames[offset + i], i) for i in range(len(defaults)))
+        kwdefaults = getattr(fn, '__kwdefaults__', None) or {}
+        return layout + tuple((name, None) for name in kwdefaults)
+
+    @staticmethod
+    def _rebuild(fn, layout):
+        """ Computes the injectable params from the cached layout, returns
+            None when it doesn't match the function.
+        """
+        defaults = fn.__defaults__ or ()
+        kwdefaults = getattr(fn, '__kwdefaults__', None) or {}
+        if len(layout) != len(defaults) + len(kwdefaults):
+            return None
+
+        mapping = {}
+        try:
+            for name, index in layout:
+                default = kwdefaults[name] if index is None else defaults[index]
+                if default is Key:
+                    default = fn.__annotations__[name]
+                if isinstance(default, Key):
+                    mapping[name] = default.value
+                elif inspect.isclass(default):
+                    mapping[name] = default
+        except (IndexError, KeyError):
+            return None
+        return mapping
+
+
+def bake_defaults(fn, values, defaults, kwdefaults):
+    """ Helper function to compute the __defaults__ and __kwdefaults__ of a
+        function replacing the ones for the given names by the given values.
+        Returns None when some of the names don't have a default.
+    """
+    code = fn.__code__
+    defaults = list(defaults or ())
+    kwdefaults = dict(kwdefaults or {})
+    argnames = code.co_varnames[:code.co_argcount]
+    offset = len(argnames) - len(defaults)
+
+    for name, value in values.items():
+        if name in kwdefaults:
+            kwdefaults[name] = value
+        elif name in argnames and argnames.index(name) >= offset:
+            defaults[argnames.index(name) - offset] = value
+        else:
+            return None
+
+    return tuple(defaults) or None, kwdefaults or None
+
+
+class EventSampler(object):
+    """ Delivers a sample of the injection and factory events to a callback,
+        as dicts with the function (for injections), key, scope, whether the
+        value was already built (hit) and the latency in seconds.
+
+            {'event': 'inject', 'function': 'app.views.index', 'key': Redis,
+             'scope': 'singleton', 'hit': True, 'latency': 1.2e-06}
+
+        Events are sampled 1 in `every`, and then limited to `rate` events
+        per second for each function or key with a token bucket of `burst`
+        size. Without a callback events are logged.
+    """
+
+    def __init__(self, callback=None, every=1, rate=None, burst=None):
+        self.callback = callback or self._log
+        self.every = every
+        self.rate = rate
+        self.burst = burst or rate
+        self._counter = itertools.count()
+        # Token buckets as {key: (tokens, last update)}
+        self._buckets = {}
+
+    @staticmethod
+    def _log(event):
+        logger.info('Injection event: %r', event)
+
+    def sample(self, key):
+        if self.every > 1 and next(self._counter) % self.every:
+            return False
+        if self.rate is None:
+            return True
+
+        now = timer()
+        tokens, last = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+    def emit(self, event):
+        try:
+            self.callback(event)
+        except Exception:
+            logger.exception('Unable to deliver injection event')
+
+
+# Sampler receiving the injection events, None while they're disabled
+_sampler = [None]
+
+
+def enable_events(callback=None, every=1, rate=None, burst=None):
+    """ Starts delivering injection events to a callback, it can be done at
+        any time. When disabled they cost a single check for every injected
+        param and factory run. See `EventSampler` for the arguments.
+
+            enable_events(statsd_callback, every=100, rate=10)
+    """
+    _sampler[0] = EventSampler(callback, every=every, rate=rate, burst=burst)
+    return _sampler[0]
+
+
+def disable_events():
+    """ Stops delivering injection events """
+    _sampler[0] = None
+
+
+def _describe(deps, key):
+    describe = getattr(deps, '_describe', None)
+    if describe is None:
+        return 'value', True
+    return describe(key)
+
+
+class ScopeRequired(LookupError):
+    """ Raised when resolving a scoped dependency outside a scope """
+
+
+class DependencyScope(object):
+    """ Holds the scoped dependencies acquired while it's open, releasing
+        them when closed, the last acquired first. See `dependency_scope`.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._factories = []
+
+    def __contains__(self, key):
+        return any(k == key for _, k in self._values)
+
+    def acquire(self, deps, key, factory, resolver=None):
+        """ Obtains the instance of a scoped dependency, running its
+            generator factory up to its first yield. The factory is given
+            `resolver` if any instead of `deps`.
+        """
+        # Maps like dict are not hashable, use their identity
+        scope_key = (id(deps), key)
+        try:
+            return self._values[scope_key]
+        except KeyError:
+            pass
+
+        logger.debug('Acquiring scoped dependency %s', key)
+        generator = factory(deps if resolver is None else resolver)
+        value = next(generator)
+        self._factories.append((key, generator))
+        self._values[scope_key] = value
+        return value
+
+    def close(self):
+        """ Releases the acquired dependencies running their factories to
+            completion.
+        """
+        while self._factories:
+            key, generator = self._factories.pop()
+            logger.debug('Releasing scoped dependency %s', key)
+            try:
+                next(generator)
+            except StopIteration:
+                pass
+            except Exception:
+                logger.exception('Unable to release scoped dependency %s', key)
+            else:
+                generator.close()
+                logger.warning('Factory for scoped dependency %s yielded more than once', key)
+        self._values.clear()
+
+
+# Scope of the dependencies resolved in the current context
+_scope_var = ContextVar('di.scope', default=None)
+
+
+@contextmanager
+def dependency_scope():
+    """ Context manager opening a scope for the scoped dependencies (see
+        `DependencyMap.scoped`), released when the block exits. Nested
+        scopes reuse the outer one.
+
+            with dependency_scope():
+                handle(request)
+
+        Injected functions open a scope on their own when they need one,
+        lasting until they return. Generators (and async generators and
+        coroutines on Python 3) hold theirs until they are exhausted or
+        closed.
+    """
+    current = _scope_var.get()
+    if current is not None:
+        yield current
+        return
+
+    scope = DependencyScope()
+    _scope_var.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope_var.set(None)
+        scope.close()
+
+
+def _collect_kwargs(*args, **kwargs):
+    return kwargs
+
+
+# Statistics of the functions memoized by an injector
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+# Values resolved in the current resolution session, see `resolution_session`
+_session_var = ContextVar('di.session', default=None)
+
+
+@contextmanager
+def resolution_session():
+    """ Context manager opening a resolution session, where the injectors
+        created with `session` enabled resolve every dependency just once,
+        factories included. Nested sessions reuse the outer one.
+
+            with resolution_session():
+                handle(request)
+
+        Injectors with `session` enabled open one on their outermost call
+        when there is none, so it's only needed to extend a session beyond
+        a single injected call.
+    """
+    if _session_var.get() is not None:
+        yield
+        return
+
+    _session_var.set({})
+    try:
+        yield
+    finally:
+        _session_var.set(None)
+
+
+def injector(dependencies, warn=True, follow_wrapped=False, isolate=False, lazy=False,
+             cache_dir=None, session=False):
     """ Factory for the dependency injection decorator. It's meant to be
         initialized with the map of dependencies to use on decorated functions.
 
@@ -116,7 +713,8 @@ def injector(dependencies, warn=True, follow_wrapped=False):
 
         Dependency resolution is very straightforward, no inheritance is taken
         into account, the dependency map must be initialized with the actual
-        classes used to annotate the decorated functions.
+        classes used to annotate the decorated functions (unless the map has
+        `inherit` enabled, see `DependencyMap`).
 
         When a decorated method defines a dependency not correctly configured
         in the map it will raise a LookupError to indicate so.
@@ -136,91 +734,478 @@ def injector(dependencies, warn=True, follow_wrapped=False):
         argument', make sure that all calls to the decorated method always use
         keyword arguments for injected values. Use of positional injected arguments
         is not supported.
-    """
 
-    if isinstance(dependencies, (types.FunctionType, types.BuiltinFunctionType, functools.partial)):
-        raise RuntimeError('It seems injector is being used as a decorator instead of a decorator factory. Usage: inject = injector(deps)')
+        By default patching the decorator affects the whole process. When
+        `isolate` is enabled the patch stack is kept in a context variable,
+        so every thread (or asyncio task) pushes and pops its own overrides
+        while starting from the dependencies given here.
 
-    # Prepare the dependencies storage stack
-    deps_stack = [dependencies]
+            inject = injector(deps, isolate=True)
 
-    def wrapper(fn, __warn__=warn, follow_wrapped=follow_wrapped):
-        # Mapping for injectable values (classes used as default value)
-        mapping = {}
-        defaults = get_callable_defaults(fn, follow_wrapped=follow_wrapped)
-        for name, default in defaults.items():
-            if isinstance(default, Key):
-                mapping[name] = default.value
-            elif inspect.isclass(default):
-                mapping[name] = default
+            def test_foo():
+                inject.patch({Redis: FakeRedis()})  # only seen by this thread
+                ...
+                inject.unpatch()
+
+        The deprecated `dependencies` property is not supported in this mode.
+
+        Inspecting the signature of every decorated function has a noticeable
+        cost when importing large code bases. With `lazy` enabled decorated
+        functions are only inspected when first called or when warming them
+        up explicitly, for instance before forking the workers of a server.
+
+            inject = injector(deps, lazy=True)
+            ...
+            inject.prepare_all()
+
+        In this mode functions without injectable params are always wrapped.
+
+        The injectable params can also be persisted in `cache_dir`, so later
+        process starts don't need to inspect the decorated functions again
+        (see `MetadataCache`).
+
+        Once the dependencies are configured, decorated functions whose
+        dependencies are all plain values or singletons can be baked. Their
+        resolved dependencies are written as the defaults of the original
+        function, the wrapper just forwards the call to it and module level
+        functions are replaced by the original one, so calling them has no
+        overhead at all. Later changes to the dependency map are not seen by
+        baked functions, patching a baked injector bakes them again though.
 
-        if __warn__ and not mapping:
-            warnings.warn('{0}: No injectable params found. You can safely remove the decorator.'.format(fn.__name__), stacklevel=2)
-            return fn
+            inject.bake()
+            ...
+            inject.unbake()
 
-        # Micro optimization: prepare mapping as a list of pairs
-        pairs = tuple(mapping.items())
+        Factories run again on every injection, so nested injected functions
+        asking for the same dependency build it several times. With `session`
+        enabled the outermost injected call opens a resolution session and
+        the values resolved in it are reused by the nested calls until it
+        returns (see `resolution_session`).
+
+            inject = injector(deps, session=True)
+
+        Pure functions can be memoized taking into account the dependencies
+        injected in each call, so patching the injector or modifying the map
+        never returns stale results (see `memoize`).
+
+            @inject.memoize(maxsize=1024)
+            def compute_price(sku, rules=PricingRules):
+                ...
+    """
+
+    if isinstance(dependencies, (types.FunctionType, types.BuiltinFunctionType, functools.partial)):
+        raise RuntimeError('It seems injector is being used as a decorator instead of a decorator factory. Usage: inject = injector(deps)')
+
+    # Prepare the dependencies storage stack, an immutable tuple replaced on
+    # every patch so callers in other threads never see it half modified
+    deps_stack = [(dependencies,)]
+    patch_lock = threading.Lock()
+    # Isolated stacks are immutable tuples so each context can extend its own
+    stack_var = ContextVar('di.injector.stack', default=(dependencies,))
+    inspector = MetadataCache.for_path(cache_dir).get_injectables if cache_dir else get_injectables
+    # Wrappers of the decorated functions and their state, for baking them
+    # and inspecting the lazy ones, not keeping them alive
+    decorated = weakref.WeakKeyDictionary()
+    baking = [False]
+
+    def wrapper(fn, __warn__=warn, follow_wrapped=follow_wrapped, cache=None, lazy=lazy, collect=False):
+        # With `collect` the wrapper returns the keyword arguments with the
+        # injected params instead of calling the function (see `memoize`)
+        def prepare(stacklevel=2):
+            # Mapping for injectable values (classes used as default value)
+            mapping = inspector(fn, follow_wrapped=follow_wrapped)
+            if __warn__ and not mapping:
+                warnings.warn('{0}: No injectable params found. You can safely remove the decorator.'.format(fn.__name__), stacklevel=stacklevel + 1)
+
+            # Micro optimization: prepare mapping as a list of pairs
+            state[0] = tuple(mapping.items())
+            return state[0]
+
+        # Holds the injectable pairs once the function has been inspected,
+        # if it's baked and its original defaults when baked
+        state = [None, False, None]
+        if not lazy and not prepare():
+            # Nothing to inject, avoid the overhead of wrapping the function
+            return _collect_kwargs if collect else fn
+
+        check_deprecated = __warn__ and not isolate
+
+        # Generators and coroutines are given their injected params when
+        # they start running, so scoped dependencies last as long as them
+        streaming = not PY2 and (inspect.isgeneratorfunction(fn) or
+                                 inspect.iscoroutinefunction(fn) or
+                                 getattr(inspect, 'isasyncgenfunction', bool)(fn))
+        target = _collect_kwargs if streaming or collect else fn
 
         # Wrapper executed on each invocation of the decorated method
         @functools.wraps(fn)
         def inner(*args, **kwargs):
+            if state[1]:
+                return target(*args, **kwargs)
+
+            memo = None
+            if session:
+                memo = _session_var.get()
+                if memo is None:
+                    with resolution_session():
+                        return inner(*args, **kwargs)
+
             # Micro optimization: cache logger level
             debug = logger.isEnabledFor(logging.DEBUG)
 
             # Alias the latest dependencies
-            deps = deps_stack[-1]
+            deps = stack_var.get()[-1] if isolate else deps_stack[0][-1]
 
             # Adapt for deprecated property
-            if __warn__ and deps is not wrapper.dependencies:
-                warnings.warn('dependencies property is deprecated, please use patch/unpatch', stacklevel=2)
-                patch(wrapper.dependencies)
-                deps = wrapper.dependencies
+            if check_deprecated and deps is not wrapper.dependencies:
+                # Both are updated by patch() while holding the lock, so they
+                # only differ there when the property was assigned
+                with patch_lock:
+                    deps = wrapper.dependencies
+                    replaced = deps is not deps_stack[0][-1]
+                    if replaced:
+                        deps_stack[0] += (deps,)
+                if replaced:
+                    warnings.warn('dependencies property is deprecated, please use patch/unpatch', stacklevel=2)
+                    if baking[0]:
+                        bake()
+
+            pairs = state[0]
+            if pairs is None:
+                pairs = prepare()
+
+            # Resolve every param from the same registrations
+            depsmap = resolver = None
+            if isinstance(deps, DependencyMap):
+                depsmap, version, table = deps._pinned()
+                if cache is not None:
+                    resolver = _PinnedMap(depsmap, table, version)
+
+            sampler = _sampler[0]
+            if sampler is not None and not sampler.sample(fn):
+                sampler = None
 
             # Iterate over the set of 'injectable' parameters
             for name, dependency in pairs:
                 # If the argument was not explicitly given inject it
                 if name not in kwargs:
                     debug and logger.debug('%s: Injecting %s with %s', fn.__name__, name, dependency)
+                    if sampler is not None:
+                        scope_name, hit = _describe(deps, dependency)
+                        start = timer()
                     # Avoid using `in` operator to check, so we can work with
                     # maps not supporting __contain__
                     try:
-                        kwargs[name] = deps[dependency]
+                        if memo is not None:
+                            # Maps like dict are not hashable, use their identity
+                            memo_key = (id(deps), dependency)
+                            value = memo.get(memo_key, _MISSING)
+                            if value is _MISSING:
+                                value = (deps[dependency] if depsmap is None else
+                                         depsmap._resolve(dependency, table))
+                                # Instances bound to a scope, thread or process are not shared
+                                if depsmap is None or not depsmap._is_bound(dependency):
+                                    memo[memo_key] = value
+                            elif sampler is not None:
+                                hit = True
+                            kwargs[name] = value
+                        elif cache is None:
+                            kwargs[name] = (deps[dependency] if depsmap is None else
+                                            depsmap._resolve(dependency, table))
+                        else:
+                            kwargs[name] = cache.resolve(deps, dependency, resolver)
                     except KeyError:
                         raise LookupError('Unable to find an instance for {0} when calling {1}'.format(
                             dependency, fn.__name__))
-
-            return fn(*args, **kwargs)
-
-        return inner
+                    except ScopeRequired:
+                        if collect or _scope_var.get() is not None:
+                            raise
+                        # Scoped dependencies last until the function returns
+                        with dependency_scope():
+                            return inner(*args, **kwargs)
+                    if sampler is not None:
+                        sampler.emit({
+                            'event': 'inject', 'function': '{0}.{1}'.format(fn.__module__, fn.__name__),
+                            'key': dependency, 'scope': scope_name, 'hit': hit, 'latency': timer() - start,
+                        })
+
+            return target(*args, **kwargs)
+
+        if collect:
+            return inner
+
+        decorated[inner] = (fn, state, prepare)
+        injected = inner
+        if streaming:
+            from . import streams
+            injected = streams.inject(fn, inner)
+
+        # Allows to re-bind the function to other dependencies, i.e. in the
+        # workers of a process pool
+        injected.__injector__ = wrapper
+        return injected
+
+    def bake_function(inner, deps):
+        fn, state, prepare = decorated[inner]
+        pairs = state[0] if state[0] is not None else prepare()
+        if not hasattr(fn, '__code__'):
+            return False
+
+        original = state[2] or (fn.__defaults__, getattr(fn, '__kwdefaults__', None))
+        is_cacheable = getattr(deps, '_is_cacheable', None)
+        values = {}
+        for name, dependency in pairs:
+            if is_cacheable and not is_cacheable(dependency):
+                return unbake_function(inner)
+            try:
+                values[name] = deps[dependency]
+            except KeyError:
+                return unbake_function(inner)
+
+        baked = bake_defaults(fn, values, *original)
+        if baked is None:
+            return unbake_function(inner)
+
+        fn.__defaults__, fn.__kwdefaults__ = baked
+        state[2] = original
+        state[1] = True
+
+        # Route module level calls straight to the original function
+        module = sys.modules.get(fn.__module__)
+        if getattr(module, fn.__name__, None) is inner:
+            setattr(module, fn.__name__, fn)
+        return True
+
+    def unbake_function(inner):
+        fn, state, _ = decorated[inner]
+        if state[1]:
+            state[1] = False
+            fn.__defaults__, fn.__kwdefaults__ = state[2]
+            module = sys.modules.get(fn.__module__)
+            if getattr(module, fn.__name__, None) is fn:
+                setattr(module, fn.__name__, inner)
+        return False
+
+    def bake():
+        """ Bakes the dependencies of the decorated functions, returns how
+            many of them were baked.
+        """
+        if isolate:
+            raise RuntimeError('Unable to bake an injector with isolated patch stacks')
+        baking[0] = True
+        deps = deps_stack[0][-1]
+        return sum(1 for inner in list(decorated.keys()) if bake_function(inner, deps))
+
+    def unbake():
+        """ Restores the decorated functions to resolve their dependencies
+            on every call.
+        """
+        baking[0] = False
+        for inner in list(decorated.keys()):
+            unbake_function(inner)
 
     def patch(deps):
-        deps_stack.append(deps)
-        wrapper.dependencies = deps
+        if isolate:
+            stack_var.set(stack_var.get() + (deps,))
+            return
+        with patch_lock:
+            deps_stack[0] += (deps,)
+            wrapper.dependencies = deps
+        if baking[0]:
+            bake()
 
     def unpatch():
-        if len(deps_stack) < 2:
-            raise RuntimeError('Unable to unpatch. Did you call patch?')
-        deps_stack.pop()
-        wrapper.dependencies = deps_stack[-1]
+        if isolate:
+            stack = stack_var.get()
+            if len(stack) < 2:
+                raise RuntimeError('Unable to unpatch. Did you call patch?')
+            stack_var.set(stack[:-1])
+            return
+        with patch_lock:
+            if len(deps_stack[0]) < 2:
+                raise RuntimeError('Unable to unpatch. Did you call patch?')
+            deps_stack[0] = deps_stack[0][:-1]
+            wrapper.dependencies = deps_stack[0][-1]
+        if baking[0]:
+            bake()
+
+    def memoize(maxsize=128):
+        """ Decorator injecting and memoizing a function, keeping up to
+            `maxsize` results (least recently used are discarded first).
+            Results are cached by the given arguments and the identity of the
+            injected dependencies, and dropped when the map is modified, so
+            it's meant for plain values and singletons. Unhashable arguments
+            raise a TypeError, as with `functools.lru_cache`. Params are
+            resolved as in the injected calls, scoped ones last until the
+            function returns.
+
+            Memoized functions expose `cache_info()` and `cache_clear()`.
+        """
+        def decorator(fn):
+            # Resolves the injectable params as calling the function would
+            resolve = wrapper(fn, __warn__=False, lazy=True, collect=True)
+            lock = threading.Lock()
+            # Results as {key: (injected values, result)}, the values are kept
+            # so their identities are not reused while cached
+            cache = OrderedDict()
+            stats = [0, 0]
+            # Map and version the cache was filled from
+            source = [None, None]
+
+            @functools.wraps(fn)
+            def memoized(*args, **kwargs):
+                deps = stack_var.get()[-1] if isolate else deps_stack[0][-1]
+                # Read before resolving, results are keyed by the injected
+                # values too so a map modified meanwhile never mixes them up
+                version = getattr(deps, 'version', None)
+                try:
+                    resolved = resolve(*args, **kwargs)
+                except ScopeRequired:
+                    if _scope_var.get() is not None:
+                        raise
+                    # Scoped dependencies last until the function returns
+                    with dependency_scope():
+                        return memoized(*args, **kwargs)
+
+                key = (args, tuple(sorted(kwargs.items())))
+                injected = [(name, value) for name, value in resolved.items() if name not in kwargs]
+                key += tuple(id(value) for _, value in injected)
+
+                with lock:
+                    if source[0] is not deps or source[1] != version:
+                        cache.clear()
+                        source[:] = [deps, version]
+                    if key in cache:
+                        stats[0] += 1
+                        entry = cache[key] = cache.pop(key)
+                        return entry[1]
+                    stats[1] += 1
+
+                kwargs.update(injected)
+                result = fn(*args, **kwargs)
+                with lock:
+                    if source[0] is deps and source[1] == version:
+                        cache[key] = (injected, result)
+                        while len(cache) > maxsize:
+                            cache.popitem(last=False)
+                return result
+
+            def cache_info():
+                return CacheInfo(stats[0], stats[1], maxsize, len(cache))
+
+            def cache_clear():
+                with lock:
+                    cache.clear()
+                    stats[:] = [0, 0]
+
+            memoized.cache_info = cache_info
+            memoized.cache_clear = cache_clear
+            return memoized
+
+        return decorator
+
+    def prepare_all():
+        """ Inspects all the lazily decorated functions not called yet """
+        count = 0
+        for _, state, prepare in list(decorated.values()):
+            if state[0] is None:
+                prepare()
+                count += 1
+        return count
 
     # Allow calling sites to change the dependency map
     wrapper.patch = patch
     wrapper.unpatch = unpatch
+    wrapper.prepare_all = prepare_all
+    wrapper.bake = bake
+    wrapper.unbake = unbake
+    wrapper.memoize = memoize
 
     # Deprecated: Expose the dependency map publicly in the decorator
-    wrapper.dependencies = deps_stack[-1]
+    wrapper.dependencies = dependencies
 
     return wrapper
 
 
-def MetaInject(inject_fn):
+class ResolutionCache(object):
+    """ Keeps the plain values and singletons resolved from a dependency map
+        until it's modified. It can be shared by several injected functions.
+
+            cache = ResolutionCache()
+            inject(fn, cache=cache)
     """
-        Builds a metaclass with the *injector* parameter as dependecy injector.
+
+    def __init__(self):
+        # Replaced as a whole so concurrent readers always see a consistent state
+        self._state = (None, None, {})
+
+    def resolve(self, deps, key, resolver=None):
+        """ Resolves a key from `deps`, or from `resolver` if given (see
+            `DependencyMap.pin`) when not cached.
+        """
+        if resolver is None:
+            resolver = deps
+        version = getattr(resolver, 'version', None)
+        # Maps not tracking their changes can't be cached
+        if version is None:
+            return resolver[key]
+
+        cached_deps, cached_version, values = self._state
+        if cached_deps is not deps or cached_version != version:
+            values = {}
+            self._state = (deps, version, values)
+        elif key in values:
+            return values[key]
+
+        value = resolver[key]
+        if deps._is_cacheable(key):
+            values[key] = value
+        return value
+
+
+def _inject_members(inject_fn, members, cache=None):
+    """ Generates the injected version of the class members having injectable
+        params, each one is inspected just once by the injector.
+    """
+    kwargs = {'__warn__': False}
+    if cache is not None:
+        kwargs['cache'] = cache
+
+    def inject_member(name, member):
+        if isinstance(member, (staticmethod, classmethod)):
+            fn = inject_member(name, member.__func__)
+            return fn and type(member)(fn)
+
+        if isinstance(member, property):
+            accessors = (member.fget, member.fset, member.fdel)
+            injected = [fn and inject_member(name, fn) for fn in accessors]
+            if not any(injected):
+                return None
+            return property(*[new or old for new, old in zip(injected, accessors)],
+                            doc=member.__doc__)
+
+        # Operator overloads are skipped but the constructor
+        if name != '__init__' and (name[:2] == '__' or name[-2:] == '__'):
+            return None
+        if not callable(member) or inspect.isclass(member):
+            return None
+
+        fn = inject_fn(member, **kwargs)
+        return fn if fn is not member else None
+
+    for name, member in list(members.items()):
+        injected = inject_member(name, member)
+        if injected is not None:
+            yield name, injected
+
+
+def MetaInject(inject_fn, cache=False):
     """
+        Builds a metaclass with the *injector* parameter as dependecy injector.
 
-    def is_user_function(name, fn):
-        """ Checks that a function isn't named as an operator overload (__name__) """
-        return callable(fn) and name[:2] != '__' and name[-2:] != '__'
+        When `cache` is enabled all the methods in the class share a
+        `ResolutionCache`.
+    """
 
     class ActualMetaInject(type):
         """
@@ -240,20 +1225,257 @@ def MetaInject(inject_fn):
         def __new__(cls, name, bases, dct):
             """
                 Generates a new instance including the injector factory for every
-                method except for *operator overloads*.
+                method, static/class method and property with injectable params
+                except for *operator overloads*.
             """
-
-            # Filter methods to be decorated
-            methods = ((k, v) for (k, v) in dct.items() if is_user_function(k, v))
-
-            for m, fn in methods:
-                dct[m] = inject_fn(fn, __warn__=False)
+            shared = ResolutionCache() if cache else None
+            dct.update(_inject_members(inject_fn, dct, shared))
 
             return type.__new__(cls, name, bases, dct)
 
     return ActualMetaInject
 
 
+def inject_class(inject_fn, cache=False):
+    """
+        Class decorator equivalent to `MetaInject`, for when a metaclass
+        can't be used.
+
+            @inject_class(inject)
+            class Foo(object):
+                def foo(self, redis=Redis):
+                    pass
+    """
+    def decorator(cls):
+        shared = ResolutionCache() if cache else None
+        for name, injected in list(_inject_members(inject_fn, vars(cls), shared)):
+            setattr(cls, name, injected)
+        return cls
+
+    return decorator
+
+
+class LazyFactory(object):
+    """ Factory given by its import reference ("package.module:callable"),
+        the module is only imported the first time the factory is run.
+
+            dm.register(Engine, LazyFactory('app.db:create_engine'),
+                        DependencyMap.FACTORY | DependencyMap.SINGLETON)
+    """
+    __slots__ = ('reference', 'import_time', '_target')
+
+    def __init__(self, reference):
+        if ':' not in reference:
+            raise ValueError('Invalid factory reference {0!r}, expected "package.module:callable"'.format(reference))
+        self.reference = reference
+        self.import_time = None
+        self._target = None
+
+    def __call__(self, deps):
+        target = self._target
+        if target is None:
+            target = self.load()
+        return target(deps)
+
+    def __repr__(self):
+        return 'LazyFactory({0!r})'.format(self.reference)
+
+    def __reduce__(self):
+        # Keep it lazy when sent to other processes
+        return (LazyFactory, (self.reference,))
+
+    def load(self):
+        """ Imports the referenced callable """
+        module_name, _, attrs = self.reference.partition(':')
+        start = timer()
+        target = importlib.import_module(module_name)
+        for attr in attrs.split('.'):
+            target = getattr(target, attr)
+        self.import_time = timer() - start
+        logger.debug('Imported factory %s in %.2fms', self.reference, self.import_time * 1000)
+
+        self._target = target
+        return target
+
+
+class PersistentFactory(object):
+    """ Factory whose result is persisted in a cache file, so later process
+        starts load it instead of running the factory again. Meant for
+        expensive but deterministic singletons, see `DependencyMap.singleton`.
+
+        Files are named after the given name and version, which must be
+        changed whenever the factory produces different results. Contents
+        are validated with a checksum and the factory is run again when
+        they are missing, corrupt or can't be unpickled.
+    """
+    MAGIC = b'DIPY1'
+
+    def __init__(self, fn, name, version=None):
+        self.fn = fn
+        self.name = name
+        self.version = version
+
+    def __call__(self, deps):
+        filename = self.filename(getattr(deps, 'cache_dir', DependencyMap.cache_dir))
+        try:
+            value = self.load(filename)
+        except (IOError, OSError):
+            # Not persisted yet
+            pass
+        except Exception as ex:
+            # Unpickling may fail in many ways, i.e. classes no longer found
+            logger.warning('Discarding persisted singleton %s: %s', filename, ex)
+        else:
+            logger.debug('Loaded persisted singleton from %s', filename)
+            return value
+
+        value = self.fn(deps)
+        self.save(filename, value)
+        return value
+
+    def filename(self, path):
+        name = self.name if self.version is None else '{0}-{1}'.format(self.name, self.version)
+        return os.path.join(path, name + '.pickle')
+
+    def load(self, filename):
+        with open(filename, 'rb') as fd:
+            # Map the file so the payload is not copied before unpickling it
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = len(PersistentFactory.MAGIC) + hashlib.sha256().digest_size
+            if data[:len(PersistentFactory.MAGIC)] != PersistentFactory.MAGIC:
+                raise ValueError('unknown format')
+            payload = memoryview(data)[header:]
+            try:
+                if hashlib.sha256(payload).digest() != data[len(PersistentFactory.MAGIC):header]:
+                    raise ValueError('checksum mismatch')
+                return pickle.loads(payload)
+            finally:
+                payload.release()
+        finally:
+            data.close()
+
+    def save(self, filename, value):
+        try:
+            payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            path = os.path.dirname(filename)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            tmpname = '{0}.{1}'.format(filename, os.getpid())
+            with open(tmpname, 'wb') as fd:
+                fd.write(PersistentFactory.MAGIC)
+                fd.write(hashlib.sha256(payload).digest())
+                fd.write(payload)
+            getattr(os, 'replace', os.rename)(tmpname, filename)
+        except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError) as ex:
+            logger.warning('Unable to persist singleton %s: %s', filename, ex)
+
+
+# Marks the entries whose instance has not been built yet
+_MISSING = object()
+
+
+class _ThreadInstances(threading.local):
+    """ Instances built for a thread scoped dependency, one per thread. The
+        copies of an entry fall back to the instances of the original one,
+        so copying it doesn't make the other threads build theirs again.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+
+    def __getattr__(self, name):
+        parent = self.__dict__.get('parent')
+        if name != 'value' or parent is None:
+            raise AttributeError(name)
+        return parent.value
+
+
+class _Entry(object):
+    """ Registration of a dependency in a map, holding its value (or factory)
+        along with its flags and the instance built for its scope: the
+        singleton, a thread local for thread scoped ones, a weak reference for
+        weak ones or (pid, instance) for process scoped ones. Plain values are
+        stored as is instead.
+    """
+    __slots__ = ('value', 'flags', 'instance', 'dispose', 'segment')
+
+    def __init__(self, value, flags=0, dispose=None, segment=None):
+        self.value = value
+        self.flags = flags
+        self.dispose = dispose
+        self.segment = segment
+        if flags & DependencyMap.THREAD:
+            self.instance = _ThreadInstances()
+        else:
+            self.instance = _MISSING
+
+    def copy(self):
+        entry = _Entry(self.value, self.flags, self.dispose, self.segment)
+        if self.flags & DependencyMap.THREAD:
+            # Instances built for the copy are not seen by the original
+            entry.instance = _ThreadInstances(self.instance)
+        else:
+            entry.instance = self.instance
+        return entry
+
+
+class _SingletonsView(object):
+    """ Read only view of the singletons built by a map, clearing it resets
+        them so they are built again when next needed.
+    """
+
+    def __init__(self, depsmap):
+        self._map = depsmap
+
+    def _items(self):
+        for key, entry in self._map._entry_items():
+            if entry.flags & DependencyMap.SINGLETON and entry.instance is not _MISSING:
+                yield key, entry.instance
+
+    def __iter__(self):
+        return (key for key, _ in self._items())
+
+    def __len__(self):
+        return sum(1 for _ in self._items())
+
+    def __contains__(self, key):
+        return any(k == key for k, _ in self._items())
+
+    def __getitem__(self, key):
+        for k, instance in self._items():
+            if k == key:
+                return instance
+        raise KeyError(key)
+
+    def clear(self):
+        for key, entry in self._map._entry_items():
+            if entry.flags & DependencyMap.SINGLETON and entry.instance is not _MISSING:
+                self._map._writable(key).instance = _MISSING
+        self._map._version = next(_versions)
+
+
+class _PinnedMap(object):
+    """ View of a map resolving every key from the registration table the
+        map had when it was pinned, see `DependencyMap.pin`.
+    """
+    __slots__ = ('_map', '_table', 'version')
+
+    def __init__(self, depsmap, table, version):
+        self._map = depsmap
+        self._table = table
+        self.version = version
+
+    def __getitem__(self, key):
+        return self._map._resolve(key, self._table, self)
+
+    def __contains__(self, key):
+        return self._map._contains(key, self._table)
+
+    def __getattr__(self, name):
+        return getattr(self._map, name)
+
+
 class DependencyMap(object):
     """
         Implements the "dict" protocol for the dependencies but applies
@@ -262,54 +1484,223 @@ class DependencyMap(object):
             FACTORY: obtain the value by executing a function
             SINGLETON: only execute the factory once
             THREAD: only execute the factory once for each unique thread
+            PROCESS: only execute the factory once for each process, so
+                     forked processes build their own instance
+            FORK_SAFE: singletons that can be built before forking, sharing
+                       them with the forked processes (see `preload_for_fork`)
+            SHARED: singletons placed in shared memory (see `shared`)
+            WEAK: like singletons while the instance is referenced somewhere
+                  else, the map only keeps a weak reference to it
+            SCOPED: generator factories acquiring the instance for the
+                    current scope and releasing it when closed (see `scoped`)
+
+        Classes are looked up as is unless `inherit` is enabled, then classes
+        not registered are provided by their first registered base class
+        (in method resolution order) or their most specific registered ABC.
+
+            >>> dm = DependencyMap()
+            >>> dm.inherit = True
+            >>> dm[Mapping] = {}
+            >>> dm[dict]  # provided by Mapping
     """
 
+    # Where persisted singletons are stored
+    cache_dir = os.environ.get('DI_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'di-py')
+    # Fall back to the base classes of a class not registered
+    inherit = False
+
     NONE = 0
     FACTORY = 1
     SINGLETON = 2
     THREAD = 4
+    PROCESS = 8
+    FORK_SAFE = 16
+    SHARED = 32
+    WEAK = 64
+    SCOPED = 128
 
     def __init__(self, *args, **kwargs):
-        self._values = dict(*args, **kwargs)
-        self._flags = {}
-        self._singletons = {}
-        self._threadlocals = threading.local()
-
-    def __call__(self, key):
+        # Registrations as (entries, overlay), both indexed by their key (see
+        # `_Entry`). Once the entries are shared with a snapshot they're not
+        # modified, the following registrations are kept in the overlay
+        self._table = (dict(*args, **kwargs), {})
+        # Instances built by a parent process, they're never released in
+        # children so their finalizers don't affect the parent's resources
+        self._inherited = []
+        # Attached shared memory segments as (segment, creator pid)
+        self._segments = {}
+        # Registrations are shared with a snapshot, and whether the overlay
+        # itself is, so it must be copied before adding to it
+        self._shared = False
+        self._overlay_shared = False
+        # Entries copied from a shared table to hold the instances built
+        # since, see `_writable`, and whether they're shared with a snapshot
+        self._built = {}
+        self._built_shared = False
+        self._saved = []
+        self._version = next(_versions)
+        # Providers found for unregistered classes as (version, {class: key})
+        self._bases = (None, {})
+        # Construction plans of the autowired classes as (version, {class: plan})
+        self._plans = (None, {})
+        self._reset_locks()
+        _all_maps.add(self)
+
+    def _reset_locks(self):
+        # Serializes the transactions and the creation of contexts
+        self._lock = threading.RLock()
+        # Serializes building each singleton, see `_initialize`
+        self._init_locks = {}
+        self._own_lock = threading.Lock()
+
+    def __call__(self, key, cache=False):
         """ descriptor factory method.
             >>> dm = DependencyMap()
             >>> class Bar(object):
                     pass
             >>> class Foo(object):
                     my_injected_dep = dm(Spam)
+                    my_cached_dep = dm(Ham, cache=True)
         """
-        return InjectorDescriptor(key, self)
+        return InjectorDescriptor(key, self, cache=cache)
 
-    def __getitem__(self, key):
+    @property
+    def version(self):
+        """ Changes every time the map is modified, allowing to cache values
+            obtained from it.
+        """
+        return self._version
+
+    @property
+    def _singletons(self):
+        return _SingletonsView(self)
+
+    def _is_cacheable(self, key):
+        """ Checks if the key always resolves to the same value for the
+            current version of the map (plain values and singletons).
+        """
+        if isinstance(key, Key):
+            key = key.value
+        entry = self._get(key)
+        if entry is _MISSING and self.inherit:
+            entry = self._get(self._find_base(key))
+        if entry.__class__ is not _Entry:
+            return True
+        if entry.flags & DependencyMap.SCOPED:
+            return False
+        return not entry.flags & DependencyMap.FACTORY or bool(entry.flags & DependencyMap.SINGLETON)
+
+    def _is_bound(self, key):
+        """ Checks if the key resolves to an instance bound to the current
+            scope, thread or process, which must not be cached beyond it.
+        """
+        if isinstance(key, Key):
+            key = key.value
+        entry = self._get(key)
+        if entry is _MISSING and self.inherit:
+            entry = self._get(self._find_base(key))
+        bound = DependencyMap.SCOPED | DependencyMap.THREAD | DependencyMap.PROCESS
+        return entry.__class__ is _Entry and bool(entry.flags & bound)
+
+    def pin(self):
+        """ Returns a view of the map resolving every dependency, including
+            the ones of the factories it runs, from its current registrations.
+            Injected calls use it so they never see part of a transaction
+            published while they resolve their params.
+
+            >>> deps = dm.pin()
+            >>> deps[Config], deps[Redis]  # same registrations for both
+
+            Instances are still built and kept by the map. Only replacing the
+            registrations as a whole (`transaction`, `restore`) is not seen by
+            the view, the map can still be modified in place.
+        """
+        depsmap, version, table = self._pinned()
+        return _PinnedMap(depsmap, table, version)
+
+    def _pinned(self):
+        """ Returns the map resolving the dependencies along with its version
+            and registration table, read in this order so the version is never
+            newer.
+        """
+        version = self._version
+        return self, version, self._table
+
+    def _resolve(self, key, table=None, deps=None):
+        """ Resolves a key from the given registration table, factories are
+            given `deps` so their own dependencies are resolved from it as
+            well, a view pinning that table if not given (see `pin`). Resolves
+            from the map itself by default.
+        """
         # Unwrap Key instances
         if isinstance(key, Key):
             key = key.value
+        if table is None:
+            table, deps = self._table, self
 
-        value = self._values[key]
-        flags = self._flags.get(key, DependencyMap.NONE)
+        entries, overlay = table
+        try:
+            if overlay and key in overlay:
+                entry = overlay[key]
+            else:
+                entry = entries[key]
+        except KeyError:
+            if not self.inherit:
+                raise
+            base = self._find_base(key)
+            if base is None:
+                raise
+            key = base
+            entry = self._lookup(key, table)
+
+        if entry.__class__ is not _Entry:
+            return entry
+        flags = entry.flags
+        if not flags & DependencyMap.FACTORY:
+            return entry.value
+        if self._built and self._get(key) is entry:
+            entry = self._built.get(key, entry)
 
         # HACK: Somewhat complex code but we strive for performance here
         try:
-            if flags & DependencyMap.FACTORY:
-                if flags & DependencyMap.SINGLETON:
-                    if key not in self._singletons:
-                        logger.debug('Running singleton factory for dependency %s', key)
-                        self._singletons[key] = value(self)
-                    value = self._singletons[key]
-                elif flags & DependencyMap.THREAD:
-                    if not hasattr(self._threadlocals, key):
-                        logger.debug('Running thread factory for dependency %s in thread (%d)',
-                                     key, thread.get_ident())
-                        setattr(self._threadlocals, key, value(self))
-                    value = getattr(self._threadlocals, key)
+            if flags & DependencyMap.SINGLETON:
+                value = entry.instance
+                if value is _MISSING:
+                    value = self._initialize(key, table, deps)
+            elif flags & DependencyMap.THREAD:
+                try:
+                    value = entry.instance.value
+                except AttributeError:
+                    logger.debug('Running thread factory for dependency %s in thread (%d)',
+                                 key, thread.get_ident())
+                    value = entry.value(deps or self._view(table))
+                    self._writable(key, table).instance.value = value
+            elif flags & DependencyMap.WEAK:
+                ref = entry.instance
+                value = None if ref is _MISSING else ref()
+                if value is None:
+                    value = self._initialize(key, table, deps)
+            elif flags & DependencyMap.PROCESS:
+                built = entry.instance
+                if built is _MISSING or built[0] != _get_pid():
+                    value = self._initialize(key, table, deps)
                 else:
-                    logger.debug('Running factory for dependency %s', key)
-                    value = value(self)
+                    value = built[1]
+            elif flags & DependencyMap.SCOPED:
+                scope = _scope_var.get()
+                if scope is None:
+                    raise ScopeRequired('Scoped dependency {0!r} must be resolved within a scope'.format(key))
+                value = scope.acquire(self, key, entry.value, deps or self._view(table))
+            else:
+                logger.debug('Running factory for dependency %s', key)
+                deps = deps or self._view(table)
+                if _sampler[0] is None:
+                    value = entry.value(deps)
+                else:
+                    value = self._build(key, 'factory', entry.value, deps)
+        except ScopeRequired:
+            # Injected functions open a scope when they get it
+            raise
         except Exception as e:
             # factory method's exceptions might occur at devel time,
             # better to log them in an unpleasant way to fix them quickly
@@ -318,19 +1709,153 @@ class DependencyMap(object):
 
         return value
 
+    __getitem__ = _resolve
+
+    def _initialize(self, key, table, deps):
+        """ Builds the instance of a singleton, weak or process scoped
+            dependency. Threads resolving the same key wait for the one
+            building it, so it's only built once.
+        """
+        deps = deps or self._view(table)
+        lock = self._init_locks.get(key)
+        if lock is None:
+            lock = self._init_locks.setdefault(key, threading.RLock())
+
+        with lock:
+            entry = self._entry(key, table)
+            flags = entry.flags
+            if flags & DependencyMap.SINGLETON:
+                if entry.instance is not _MISSING:
+                    return entry.instance
+                logger.debug('Running singleton factory for dependency %s', key)
+                if flags & DependencyMap.SHARED:
+                    value = self._attach_shared(key, entry, deps)
+                else:
+                    value = self._build(key, 'singleton', entry.value, deps)
+                self._writable(key, table).instance = value
+            elif flags & DependencyMap.WEAK:
+                value = None if entry.instance is _MISSING else entry.instance()
+                if value is not None:
+                    return value
+                logger.debug('Running weak factory for dependency %s', key)
+                value = self._build(key, 'weak', entry.value, deps)
+                try:
+                    ref = weakref.ref(value)
+                except TypeError:
+                    raise TypeError('Weak scoped dependency {0!r} must support weak references, '
+                                    'got {1!r}'.format(key, type(value)))
+                self._writable(key, table).instance = ref
+            else:
+                pid = _get_pid()
+                built = entry.instance
+                if built is not _MISSING and built[0] == pid:
+                    return built[1]
+                logger.debug('Running process factory for dependency %s in process (%d)', key, pid)
+                value = self._build(key, 'process', entry.value, deps)
+                if built is not _MISSING:
+                    self._inherited.append(built[1])
+                self._writable(key, table).instance = (pid, value)
+            return value
+
+    def _build(self, key, scope, factory, deps):
+        """ Runs a factory, sampling it for the injection events """
+        sampler = _sampler[0]
+        if sampler is None or not sampler.sample(key):
+            return factory(deps)
+
+        start = timer()
+        value = factory(deps)
+        sampler.emit({'event': 'factory', 'key': key, 'scope': scope, 'latency': timer() - start})
+        return value
+
+    def _describe(self, key):
+        """ Reports the scope of a key and if its value is already built """
+        if isinstance(key, Key):
+            key = key.value
+        if self._get(key) is _MISSING and self.inherit:
+            key = self._find_base(key)
+        entry = self._built.get(key) or self._get(key)
+        if entry.__class__ is not _Entry or not entry.flags & DependencyMap.FACTORY:
+            return 'value', True
+
+        flags, instance = entry.flags, entry.instance
+        if flags & DependencyMap.SINGLETON:
+            return 'singleton', instance is not _MISSING
+        if flags & DependencyMap.THREAD:
+            return 'thread', hasattr(instance, 'value')
+        if flags & DependencyMap.WEAK:
+            return 'weak', instance is not _MISSING and instance() is not None
+        if flags & DependencyMap.PROCESS:
+            return 'process', instance is not _MISSING and instance[0] == _get_pid()
+        if flags & DependencyMap.SCOPED:
+            scope = _scope_var.get()
+            return 'scoped', scope is not None and key in scope
+        return 'factory', False
+
     def __setitem__(self, key, value):
-        # Make sure we remove any flags associated with the key
-        if key in self._flags:
-            del self._flags[key]
+        # Unwrap Key instances
+        if isinstance(key, Key):
+            key = key.value
 
-        self._values[key] = value
+        # Any flags associated with the key are removed
+        self._put(key, value)
+        self._version = next(_versions)
 
     def __contains__(self, key):
+        return self._contains(key)
+
+    def _contains(self, key, table=None):
         # Unwrap Key instances
         if isinstance(key, Key):
             key = key.value
 
-        return key in self._values
+        try:
+            return self._get(key, table) is not _MISSING or (self.inherit and self._find_base(key) is not None)
+        except (TypeError, LookupError):
+            # Unhashable or ambiguous keys are not provided
+            return False
+
+    def _find_base(self, cls):
+        """ Finds the registered key providing an unregistered class, the
+            first registered base class in its MRO, otherwise the most specific
+            registered ABC (or `object`). Results are memoized until the map is
+            modified.
+        """
+        version, index = self._bases
+        if version != self._version:
+            index = {}
+            self._bases = (self._version, index)
+
+        try:
+            return index[cls]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+
+        base = None
+        if isinstance(cls, type):
+            for k in cls.__mro__[1:]:
+                if k is not object and self._get(k) is not _MISSING:
+                    base = k
+                    break
+            else:
+                # Classes registered with an ABC don't have it in their MRO
+                candidates = [k for k, _ in self._items()
+                              if isinstance(k, type) and k is not cls and issubclass(cls, k)]
+                # Discard the bases of other candidates
+                candidates = [k for k in candidates
+                              if not any(c is not k and issubclass(c, k) for c in candidates)]
+                if len(candidates) > 1:
+                    raise LookupError('Ambiguous dependency {0!r}, provided by {1}'.format(
+                        cls, ', '.join(sorted(repr(c) for c in candidates))))
+                if candidates:
+                    base = candidates[0]
+            if base is not None:
+                logger.debug('Dependency %s provided by its base %s', cls, base)
+
+        index[cls] = base
+        return base
 
     def __enter__(self):
         """ ContextManager interface to temporally modify dependencies.
@@ -340,46 +1865,539 @@ class DependencyMap(object):
             >>>    deps[MyClass] = False
             >>> assert deps[MyClass] is True
         """
-        self._saved = (self._values, self._flags)
-        self._values = dict((k, v) for k, v in self._values.items())
-        return self._values
+        self._saved.append(self.snapshot())
+        return self
 
     def __exit__(self, type, value, traceback):
-        self._values, self._flags = self._saved
+        self.restore(self._saved.pop())
+
+    def _lookup(self, key, table):
+        entries, overlay = table
+        if overlay and key in overlay:
+            return overlay[key]
+        return entries[key]
 
-    def proxy(self, key):
+    def _get(self, key, table=None):
+        """ Returns the registration of a key in a table, the map's own by
+            default, or `_MISSING` if not registered.
+        """
+        entries, overlay = table or self._table
+        entry = overlay.get(key, _MISSING) if overlay else _MISSING
+        if entry is _MISSING:
+            entry = entries.get(key, _MISSING)
+        return entry
+
+    def _put(self, key, value):
+        """ Stores a registration, in the overlay if the entries are shared
+            with a snapshot so they're not copied.
+        """
+        if not self._shared:
+            self._table[0][key] = value
+            return
+
+        with self._own_lock:
+            entries, overlay = self._table
+            if self._overlay_shared:
+                overlay = dict(overlay)
+                self._overlay_shared = False
+            overlay[key] = value
+            self._table = (entries, overlay)
+            if key in self._built:
+                # Built for the replaced registration
+                self._own_built()
+                del self._built[key]
+
+    def _own_built(self):
+        if self._built_shared:
+            self._built = dict((k, entry.copy()) for k, entry in self._built.items())
+            self._built_shared = False
+
+    def _view(self, table):
+        return _PinnedMap(self, table, self._version)
+
+    def _entry(self, key, table):
+        entry = self._lookup(key, table)
+        if self._built and self._get(key) is entry:
+            return self._built.get(key, entry)
+        return entry
+
+    def _writable(self, key, table=None):
+        """ Returns the entry of a key to store the instance built for it. If
+            the registrations are shared with a snapshot only that entry is
+            copied.
+        """
+        if table is not None and self._get(key) is not self._lookup(key, table):
+            # Replaced since resolved from a pinned table, the instance is
+            # built for that call but not kept
+            return self._lookup(key, table).copy()
+        if not self._shared:
+            return self._table[0][key]
+
+        with self._own_lock:
+            if not self._shared:
+                return self._table[0][key]
+            self._own_built()
+            entry = self._built.get(key)
+            if entry is None:
+                entry = self._lookup(key, self._table).copy()
+                self._built[key] = entry
+            return entry
+
+    def snapshot(self):
+        """ Captures the state of the map (values, flags, singletons and
+            thread local instances) in constant time, to be restored later on.
+
+            >>> state = dm.snapshot()
+            >>> dm[Redis] = FakeRedis()
+            >>> dm.restore(state)
+
+            The registrations are shared with the snapshot instead of copied:
+            the ones made afterwards are kept apart and building an instance
+            only copies its entry. Modifying the map copies the registrations
+            made since it was first snapshotted, but not the others.
+        """
+        self._shared = self._overlay_shared = self._built_shared = True
+        return (self._table, self._built)
+
+    def restore(self, state):
+        """ Restores the map to a state obtained with `snapshot`. The same
+            state can be restored any number of times.
+        """
+        self._table, self._built = state
+        self._shared = self._overlay_shared = self._built_shared = True
+        self._version = next(_versions)
+
+    @contextmanager
+    def transaction(self):
+        """ Context manager to reconfigure several dependencies at once while
+            other threads keep resolving them. Changes are staged in a copy of
+            the map and published when the block exits, replacing the whole
+            registration table at once, so readers see either all of them or
+            none. Nothing is published if the block raises.
+
+            >>> with dm.transaction() as tx:
+                    tx[Config] = new_config
+                    tx.singleton(Redis)(redis_factory)
+
+            Transactions are serialized, other writers should use them too.
+            The instances built for the registrations not modified are kept.
+        """
+        with self._lock:
+            staging = DependencyMap()
+            staging.inherit = self.inherit
+            # Private copy of the registrations, staged ones are kept in its
+            # overlay so the map itself is never marked as shared
+            with self._own_lock:
+                staged = dict(self._items())
+                staged.update(self._built)
+            staging._table = (staged, {})
+            staging._shared = True
+            yield staging
+
+            if not staging._table[1]:
+                return
+            entries = dict(staged)
+            entries.update(staging._table[1])
+            with self._own_lock:
+                for key, entry in list(entries.items()):
+                    live = self._built.get(key) or self._get(key)
+                    if (entry.__class__ is _Entry and live.__class__ is _Entry and
+                            live.value is entry.value and live.flags == entry.flags and
+                            live.dispose is entry.dispose and live.segment == entry.segment):
+                        # Keep the live entry along with the instances built by readers
+                        entries[key] = live
+                self._table = (entries, {})
+                self._built = {}
+                self._overlay_shared = self._built_shared = False
+            self._version = next(_versions)
+            logger.debug('Published transaction')
+
+    def proxy(self, key, bind=False):
         """ Proxy factory method.
 
             >>> dm = DependencyMap()
             >>> my_injected_dep = dm.proxy(Spam)
+            >>> my_bound_dep = dm.proxy(Ham, bind=True)
         """
-        return InjectorProxy(self, key)
+        return InjectorProxy(self, key, bind=bind)
 
-    def register(self, key, value, flags=NONE):
-        """ Register a new dependency optionally giving it a set of flags
+    def register(self, key, value, flags=NONE, dispose=None):
+        """ Register a new dependency optionally giving it a set of flags.
+            Process scoped dependencies can also have a dispose function,
+            called with the instance in the parent process before forking.
         """
+        self._register(key, value, flags, dispose)
+
+    def _register(self, key, value, flags=NONE, dispose=None, segment=None):
         logger.debug('Registered %s with flags=%d', key, flags)
         # Unwrap Key instances
         if isinstance(key, Key):
             key = key.value
 
-        self._values[key] = value
-        self._flags[key] = flags
-
-    def factory(self, key, flags=NONE):
+        if flags == DependencyMap.NONE and dispose is None:
+            self._put(key, value)
+        else:
+            self._put(key, _Entry(value, flags, dispose, segment))
+        if flags & DependencyMap.PROCESS:
+            _process_maps.add(self)
+        self._version = next(_versions)
+
+    def _items(self):
+        """ Lists the (key, registration) pairs of the map """
+        entries, overlay = self._table
+        if not overlay:
+            return list(entries.items())
+        return [(key, entry) for key, entry in entries.items() if key not in overlay] + list(overlay.items())
+
+    def _entry_items(self):
+        """ Lists the (key, entry) pairs of the registrations having flags """
+        built = self._built
+        return [(key, built.get(key, entry)) for key, entry in self._items()
+                if entry.__class__ is _Entry]
+
+    def _registrations(self):
+        """ Yields the (key, value, flags, dispose, segment) registrations """
+        for key, entry in self._items():
+            if entry.__class__ is _Entry:
+                yield key, entry.value, entry.flags, entry.dispose, entry.segment
+            else:
+                yield key, entry, DependencyMap.NONE, None, None
+
+    def _dispose_processes(self):
+        """ Releases the process scoped instances having a dispose function,
+            they will be built again when next needed.
+        """
+        for key, entry in self._entry_items():
+            if entry.dispose is None or entry.instance is _MISSING or entry.instance[0] != _get_pid():
+                continue
+            instance = entry.instance[1]
+            self._writable(key).instance = _MISSING
+            try:
+                entry.dispose(instance)
+            except Exception:
+                logger.exception('Unable to dispose the instance for dependency %s', key)
+
+    def factory(self, key, flags=NONE, dispose=None):
         """ Factory decorator to register functions as dependency factories
         """
         def decorator(fn):
-            self.register(key, fn, flags | DependencyMap.FACTORY)
+            self.register(key, fn, flags | DependencyMap.FACTORY, dispose=dispose)
 
         return decorator
 
-    def singleton(self, key):
-        return self.factory(key, flags=DependencyMap.SINGLETON)
+    def singleton(self, key, fork_safe=False, persist=None, version=None):
+        """ Factory decorator for singletons. When `persist` is given the
+            built instance is stored in `cache_dir` under that name and later
+            process starts load it instead of running the factory (see
+            `PersistentFactory`).
+
+            >>> @dm.singleton(RuleSet, persist='rules', version=RULES_VERSION)
+                def rules(deps):
+                    return RuleSet.compile(deps[Config].rules_path)
+        """
+        flags = DependencyMap.SINGLETON
+        if fork_safe:
+            flags |= DependencyMap.FORK_SAFE
+        if persist is None:
+            return self.factory(key, flags=flags)
+
+        def decorator(fn):
+            self.register(key, PersistentFactory(fn, persist, version), flags | DependencyMap.FACTORY)
+
+        return decorator
 
     def thread(self, key):
         return self.factory(key, flags=DependencyMap.THREAD)
 
+    def weak(self, key):
+        """ Registers a factory whose instance is shared while it's referenced
+            elsewhere, once no injected function or object holds it, it can be
+            garbage collected and is built again when next needed. Suited for
+            large dependencies seldom used.
+
+            >>> @dm.weak(ReportRenderer)
+                def renderer(deps):
+                    return ReportRenderer(deps[Config].templates)
+
+            Instances must support weak references, builtins like dict or
+            list don't but subclasses of them do.
+        """
+        return self.factory(key, flags=DependencyMap.WEAK)
+
+    def scoped(self, key):
+        """ Registers a generator factory for a scoped dependency, it yields
+            the instance acquired for the current scope and releases it when
+            resumed after the scope is closed.
+
+            >>> @dm.scoped(Connection)
+                def connection(deps):
+                    conn = deps[Pool].acquire()
+                    try:
+                        yield conn
+                    finally:
+                        deps[Pool].release(conn)
+
+            Injected functions open a scope when needed, see
+            `dependency_scope`, resolving it elsewhere raises `ScopeRequired`.
+        """
+        return self.factory(key, flags=DependencyMap.SCOPED)
+
+    def process(self, key, dispose=None):
+        """ Registers a factory executed once for each process, the instances
+            built before forking are not shared with the children. When given,
+            `dispose` is called with the parent's instance before forking.
+
+            >>> @dm.process(Pool, dispose=lambda pool: pool.close())
+                def pool(deps):
+                    return Pool(deps[Config].dsn)
+        """
+        return self.factory(key, flags=DependencyMap.PROCESS, dispose=dispose)
+
+    def preload_for_fork(self, freeze=True):
+        """ Builds every singleton marked as fork safe, to be called in the
+            parent process of prefork servers before forking the workers.
+            The garbage collector is also frozen (Python 3.7+), so those
+            objects are not written when collecting, allowing the workers to
+            keep sharing their memory pages with the parent (copy-on-write).
+
+            >>> @dm.singleton(GeoIndex, fork_safe=True)
+                def geo_index(deps):
+                    return GeoIndex.load('geo.db')
+            >>> dm.preload_for_fork()
+
+            Returns the keys of the built singletons.
+        """
+        preload = DependencyMap.SINGLETON | DependencyMap.FORK_SAFE
+        keys = [key for key, entry in self._entry_items()
+                if entry.flags & preload == preload]
+        # Resolved from this map even if it forwards to another one
+        table = self._table
+        for key in keys:
+            self._resolve(key, table)
+
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        return keys
+
+    def shared(self, key, name=None):
+        """ Registers a singleton factory producing a buffer (bytes, array,
+            memoryview...) which is placed in shared memory, so other processes
+            attach to it instead of running the factory again. The dependency
+            resolves to a read only memoryview of the segment.
+
+            >>> @dm.shared(Key('blocklist'), name='myapp-blocklist-v2')
+                def blocklist(deps):
+                    return build_blocklist().tobytes()
+
+            Segments are named after the key unless a `name` is given, which is
+            recommended to avoid clashes between applications and versions.
+            Created segments are unlinked by `close_shared`, called when the
+            creator process exits. A segment whose creator exits before filling
+            it (or takes longer than `SEGMENT_TIMEOUT`) is discarded and built
+            again. Requires Python 3.8+.
+        """
+        if isinstance(key, Key):
+            key = key.value
+
+        def decorator(fn):
+            flags = DependencyMap.SINGLETON | DependencyMap.SHARED
+            if not any(entry.segment for _, entry in self._entry_items()):
+                atexit.register(self.close_shared)
+            segment = name or 'di_' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+            self._register(key, fn, flags | DependencyMap.FACTORY, segment=segment)
+
+        return decorator
+
+    def _attach_shared(self, key, entry, deps):
+        name = entry.segment
+        data = None
+        deadline = timer() + SEGMENT_TIMEOUT
+        while True:
+            creator = None
+            try:
+                segment = _open_segment(name)
+            except FileNotFoundError:
+                if data is None:
+                    data = memoryview(self._build(key, 'singleton', entry.value, deps)).cast('B')
+                try:
+                    segment = _open_segment(name, create=True, size=_SEGMENT_HEADER.size + data.nbytes)
+                except FileExistsError:
+                    # Another process created it in the meantime
+                    continue
+                logger.debug('Created shared memory segment %s for dependency %s', name, key)
+                creator = os.getpid()
+                _SEGMENT_HEADER.pack_into(segment.buf, 0, 0, 0, creator)
+                segment.buf[_SEGMENT_HEADER.size:_SEGMENT_HEADER.size + data.nbytes] = data
+                _SEGMENT_HEADER.pack_into(segment.buf, 0, data.nbytes, 1, creator)
+            except ValueError:
+                # Created by another process but not sized yet
+                if timer() > deadline:
+                    _discard_segment(name)
+                    deadline = timer() + SEGMENT_TIMEOUT
+                time.sleep(0.01)
+                continue
+
+            size = _wait_segment(segment)
+            if size is not None:
+                break
+            # The creator exited (or hung) before filling it
+            segment.close()
+            _discard_segment(name)
+            deadline = timer() + SEGMENT_TIMEOUT
+
+        self._segments[key] = (segment, creator)
+        return segment.buf[_SEGMENT_HEADER.size:_SEGMENT_HEADER.size + size].toreadonly()
+
+    def close_shared(self):
+        """ Detaches from the shared memory segments, unlinking the ones
+            created by this process. Resolving them again attaches again.
+        """
+        for key, (segment, creator) in list(self._segments.items()):
+            if self._get(key) is not _MISSING:
+                self._writable(key).instance = _MISSING
+            if creator == os.getpid():
+                _unlink_segment(segment)
+            try:
+                segment.close()
+            except BufferError:
+                logger.warning('Shared memory segment for %s is still referenced', key)
+        self._segments.clear()
+
+    def register_many(self, factories, flags=NONE):
+        """ Registers several factories at once, for instance from a config
+            mapping. Factories can be given as an import reference, so their
+            modules are only imported when the dependency is first resolved,
+            and with their own flags using a (factory, flags) tuple.
+
+            >>> dm.register_many({
+                    Engine: ('app.db:create_engine', DependencyMap.SINGLETON),
+                    Client: 'app.clients:create_client',
+                })
+        """
+        for key, factory in factories.items():
+            factory_flags = flags
+            if isinstance(factory, tuple):
+                factory, factory_flags = factory
+            if isinstance(factory, string_types):
+                factory = LazyFactory(factory)
+            self.register(key, factory, factory_flags | DependencyMap.FACTORY)
+
+    def spec(self):
+        """ Builds a picklable description of the registered dependencies,
+            without the instances built so far, to build an equivalent map in
+            other processes. Factories are pickled by reference, so they must
+            be defined at module level (or given as import references).
+        """
+        return DependencyMapSpec(type(self), tuple(self._registrations()), self.inherit)
+
+    def autowire(self, cls):
+        """ Builds an instance of a class resolving the params of its
+            constructor based on their type hints (or `Key` and class defaults,
+            like injected functions). Classes not registered in the map are
+            autowired too, as long as all their params can be resolved, except
+            builtin types like `int` or `str`.
+
+                class Service(object):
+                    def __init__(self, redis: Redis, repository: Repository):
+                        ...
+
+                >>> dm.singleton(Service)(lambda deps: deps.autowire(Service))
+
+            The construction plan of every class is compiled the first time
+            and reused until the map is modified. Params which can't be
+            resolved raise a LookupError when compiling it, before building
+            any instance.
+        """
+        return self._plan(cls, ())()
+
+    def _plan(self, cls, building):
+        version, plans = self._plans
+        if version != self.version:
+            plans = {}
+            self._plans = (self.version, plans)
+
+        try:
+            return plans[cls]
+        except KeyError:
+            pass
+
+        if cls in building:
+            raise LookupError('Unable to autowire {0!r}, circular dependency: {1}'.format(
+                cls, ' -> '.join(repr(c) for c in building + (cls,))))
+
+        hints = get_type_hints(cls.__init__)
+        steps = []
+        missing = []
+        for name, default in get_init_params(cls):
+            key = hints.get(name)
+            if isinstance(default, Key):
+                key = default.value
+            elif inspect.isclass(default) and default is not Key:
+                # Classes used as default are injected like `get_injectables` does
+                key = default
+            elif default is not Key:
+                # Params with a default are only injected when registered
+                if key is not None and key in self:
+                    steps.append((name, key, None))
+                continue
+
+            if key is None:
+                missing.append(name)
+            elif key in self:
+                steps.append((name, key, None))
+            elif inspect.isclass(key) and key.__module__ not in ('builtins', '__builtin__'):
+                # Fails as well if the class can't be fully resolved
+                steps.append((name, None, self._plan(key, building + (cls,))))
+            else:
+                # Builtin types like int or str are never built from scratch
+                missing.append(name)
+
+        if missing:
+            raise LookupError('Unable to autowire {0!r}, unresolvable params: {1}'.format(
+                cls, ', '.join(missing)))
+
+        def build():
+            kwargs = {}
+            for name, key, plan in steps:
+                kwargs[name] = self[key] if plan is None else plan()
+            return cls(**kwargs)
+
+        logger.debug('Compiled construction plan for %s', cls)
+        plans[cls] = build
+        return build
+
+    def import_timings(self):
+        """ Reports the time spent importing every lazy factory resolved
+            so far, indexed by their keys.
+        """
+        return dict(
+            (key, entry.value.import_time)
+            for key, entry in self._entry_items()
+            if isinstance(entry.value, LazyFactory) and entry.value.import_time is not None
+        )
+
+
+class DependencyMapSpec(object):
+    """ Picklable description of the dependencies registered in a map, see
+        `DependencyMap.spec`.
+
+            >>> spec = dm.spec()
+            >>> dm = spec.build()  # in other process
+    """
+
+    def __init__(self, map_class, entries, inherit=False):
+        self.map_class = map_class
+        self.entries = entries
+        self.inherit = inherit
+
+    def build(self):
+        depsmap = self.map_class()
+        depsmap.inherit = self.inherit
+        for key, value, flags, dispose, segment_name in self.entries:
+            depsmap._register(key, value, flags, dispose, segment_name)
+        return depsmap
+
 
 class ContextualDependencyMap(DependencyMap):
     """ Specialized dependency map to support scenarios where different
@@ -394,43 +2412,73 @@ class ContextualDependencyMap(DependencyMap):
     def __init__(self, *args, **kwargs):
         super(ContextualDependencyMap, self).__init__(*args, **kwargs)
         self._maps = {}
-        self.map = self
+        # Map switched to by `context` for the whole process
+        self._map = self
+        # Map activated for the current thread or task, see `activate`
+        self._active = ContextVar('di.context', default=None)
+
+    @property
+    def map(self):
+        """ The active dependency map, the one activated in the current
+            thread or task if any, otherwise the one switched to.
+        """
+        active = self._active.get()
+        return self._map if active is None else active
+
+    @map.setter
+    def map(self, depsmap):
+        if self._active.get() is None:
+            self._map = depsmap
+        else:
+            self._active.set(depsmap)
 
     @contextmanager
     def activate(self, context):
         """ Context manager to temporary activate a given DependencyMap
-            for the duration of the with block.
+            for the duration of the with block. Only the current thread
+            (or asyncio task) sees it, so concurrent blocks don't interfere.
 
                 with deps.activate('es'):
                     ...
         """
-        saved = self.map
+        saved = self._active.get()
         try:
-            yield self.context(context)
+            depsmap = self._context_map(context)
+            self._active.set(depsmap)
+            yield depsmap
         finally:
-            self.map = saved
+            self._active.set(saved)
 
     def context(self, context=None):
         """ Switches the active set of the dependencies. New context values
             will automatically create a DependencyMap associated with it.
             Returns the dependency map instance switched to.
+
+            The switch affects the whole process, unless called within an
+            `activate` block, where it lasts until the block exits.
         """
-        # If no context is given the context-less map is activated
+        self.map = self._context_map(context)
+        logger.debug('Switched dependency map context to: %s', context)
+        return self.map
+
+    def _context_map(self, context):
+        # If no context is given the context-less map is used
         if context is None:
-            self.map = self
-            return self.map
+            return self
 
         # Every new context is associated with an isolated dependency
         # map, which is initialized with the current state for the root map.
         if context not in self._maps:
-            logger.debug('Initializing dependency map for context: %s', context)
-            self._maps[context] = DependencyMap()
-            for k, v in self._values.items():
-                self._maps[context].register(k, v, self._flags.get(k, DependencyMap.NONE))
-
-        logger.debug('Switched dependency map context to: %s', context)
-        self.map = self._maps[context]
-        return self.map
+            with self._lock:
+                if context not in self._maps:
+                    logger.debug('Initializing dependency map for context: %s', context)
+                    depsmap = DependencyMap()
+                    depsmap.inherit = self.inherit
+                    for registration in self._registrations():
+                        depsmap._register(*registration)
+                    # Only published once initialized for other threads
+                    self._maps[context] = depsmap
+        return self._maps[context]
 
     def reset(self):
         """ Destroys any reference to specific contexts. This method is specially
@@ -439,24 +2487,105 @@ class ContextualDependencyMap(DependencyMap):
         self._maps = {}
         self.context(None)
 
+    def preload_for_fork(self, freeze=True):
+        """ Preloads the root map and all the contexts created so far """
+        keys = super(ContextualDependencyMap, self).preload_for_fork(freeze=False)
+        for context in list(self._maps.values()):
+            context.preload_for_fork(freeze=False)
+
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        return keys
+
+    def snapshot(self):
+        """ Captures the state of the root map along with the state of every
+            context and which one is active.
+        """
+        contexts = dict((context, m.snapshot()) for context, m in self._maps.items())
+        state = super(ContextualDependencyMap, self).snapshot()
+        active = None
+        depsmap = self.map
+        for context, m in self._maps.items():
+            if m is depsmap:
+                active = context
+        return (state, contexts, active)
+
+    def restore(self, state):
+        state, contexts, active = state
+        super(ContextualDependencyMap, self).restore(state)
+
+        maps = {}
+        for context, context_state in contexts.items():
+            # Reuse the existing map instances so references to them stay valid
+            depsmap = self._maps.get(context)
+            if depsmap is None:
+                depsmap = DependencyMap()
+                depsmap.inherit = self.inherit
+            depsmap.restore(context_state)
+            maps[context] = depsmap
+        self._maps = maps
+        self.map = self if active is None else self._maps[active]
+
+    @property
+    def version(self):
+        depsmap = self.map
+        if depsmap is self:
+            return self._version
+        return depsmap.version
+
+    def _is_cacheable(self, key):
+        depsmap = self.map
+        if depsmap is self:
+            return super(ContextualDependencyMap, self)._is_cacheable(key)
+        return depsmap._is_cacheable(key)
+
+    def _is_bound(self, key):
+        depsmap = self.map
+        if depsmap is self:
+            return super(ContextualDependencyMap, self)._is_bound(key)
+        return depsmap._is_bound(key)
+
+    def _describe(self, key):
+        depsmap = self.map
+        if depsmap is self:
+            return super(ContextualDependencyMap, self)._describe(key)
+        return depsmap._describe(key)
+
+    def transaction(self):
+        """ Reconfigures the dependencies of the current context at once """
+        depsmap = self.map
+        if depsmap is self:
+            return super(ContextualDependencyMap, self).transaction()
+        return depsmap.transaction()
+
+    def _pinned(self):
+        depsmap = self.map
+        if depsmap is self:
+            return super(ContextualDependencyMap, self)._pinned()
+        return depsmap._pinned()
+
     def __getitem__(self, key):
-        if self.map is self:
+        depsmap = self.map
+        if depsmap is self:
             return super(ContextualDependencyMap, self).__getitem__(key)
         # Forward the query to the current context's map
-        return self.map[key]
+        return depsmap[key]
 
     def __setitem__(self, key, value):
         """ When setting a value it's assigned to the current map
         """
-        if self.map is self:
+        depsmap = self.map
+        if depsmap is self:
             super(ContextualDependencyMap, self).__setitem__(key, value)
         else:
-            self.map[key] = value
+            depsmap[key] = value
 
     def __contains__(self, key):
-        if self.map is self:
+        depsmap = self.map
+        if depsmap is self:
             return super(ContextualDependencyMap, self).__contains__(key)
-        return key in self.map
+        return key in depsmap
 
 
 class PatchedDependencyMap(object):
@@ -473,6 +2602,9 @@ class PatchedDependencyMap(object):
                 # Restore original dependency map
                 inject.dependencies = inject.dependencies.target
     """
+    # Patched values are not versioned, so disable caching of the target's values
+    version = None
+
     def __init__(self, depsmap):
         self.target = depsmap
         self._patched = {}
@@ -532,21 +2664,87 @@ class InjectorDescriptor(object):
         >>> dm = DependencyMap()
         >>> class MyClass(object):
                 myfoo = dm(FOO)
-        >>> 'when unit testing just clear the singletons dict'
+        >>> 'when unit testing just restore a snapshot of the map'
         >>> class FooTestCase(unittest.TestCase):
-                def setUp():
-                    dm._singletons.clear()
+                def setUp(self):
+                    self.state = dm.snapshot()
+                def tearDown(self):
+                    dm.restore(self.state)
+
+        Resolving the dependency on every attribute access can be avoided by
+        caching it, the cached value is discarded as soon as the map changes.
+
+        >>> class MyClass(object):
+                myfoo = dm(FOO, cache=True)
     """
 
-    def __init__(self, class_obj, dependencies):
+    def __init__(self, class_obj, dependencies, cache=False):
         self.class_obj = class_obj
         self.dependencies = dependencies
+        self.cache = cache
+        self.slot = '_di_cache_{0:x}'.format(id(self))
+        # Shared by all the instances for plain values and singletons
+        self._cached = (None, None)
+
+    @staticmethod
+    def slots(*names):
+        """ Generates the slot names needed to cache factory built values in
+            classes using __slots__.
+
+            >>> class MyClass(object):
+                    __slots__ = ('foo',) + InjectorDescriptor.slots('client')
+                    client = dm(Client, cache=True)
+        """
+        return tuple('_di_cache_' + name for name in names)
+
+    def __set_name__(self, owner, name):
+        self.slot = '_di_cache_' + name
 
     def __get__(self, inst, cls):
-        # Dependency map already introduces a caching mechanism, no need
-        # to insert the resolved dependency into the instance.
-        # If wanted, just iterate the cls.__dict__ looking for the key to
-        # the descriptor with same id as self
+        if self.cache:
+            return self._get_cached(inst)
+
+        # Dependency map already introduces a caching mechanism, only
+        # resolve it again when caching is not explicitly enabled.
+        return self._resolve()
+
+    def _get_cached(self, inst):
+        """ Plain values and singletons are cached in the descriptor while
+            values built by factories are cached in the instance. In both cases
+            the cache is invalidated when the dependency map changes. Scoped,
+            thread and process scoped dependencies are never cached.
+        """
+        deps = self.dependencies
+        version = getattr(deps, 'version', None)
+        # Maps not tracking their changes can't be cached
+        if version is None:
+            return self._resolve()
+
+        cached_version, value = self._cached
+        if cached_version == version:
+            return value
+
+        if deps._is_cacheable(self.class_obj):
+            value = self._resolve()
+            self._cached = (version, value)
+            return value
+
+        if inst is None or deps._is_bound(self.class_obj):
+            return self._resolve()
+
+        cached_version, value = getattr(inst, self.slot, (None, None))
+        if cached_version == version:
+            return value
+
+        value = self._resolve()
+        try:
+            setattr(inst, self.slot, (version, value))
+        except AttributeError:
+            raise TypeError('Unable to cache {0} in {1}, add {2} to its __slots__'.format(
+                self.class_obj, type(inst).__name__, self.slot))
+        return value
+
+    def _resolve(self):
         try:
             return self.dependencies[self.class_obj]
         except KeyError:
@@ -560,21 +2758,48 @@ class InjectorProxy(object):
         >>> dm = DependencyMap()
         >>> myfoo = dm.proxy(FOO)
 
+    When bound, plain values and singletons are resolved once and the proxy
+    keeps using them until the dependency map is modified.
+
+        >>> myfoo = dm.proxy(FOO, bind=True)
+
     This code is based on the LocalProxy implemented by Werkzeug
     https://github.com/pallets/werkzeug/blob/master/werkzeug/local.py#L254
     """
-    __slots__ = ('__dependencies', '__class_obj', '__dict__')
+    __slots__ = ('__dependencies', '__class_obj', '__bind', '__cached')
 
-    def __init__(self, dependencies, class_obj):
+    def __init__(self, dependencies, class_obj, bind=False):
         object.__setattr__(self, '_InjectorProxy__dependencies', dependencies)
         object.__setattr__(self, '_InjectorProxy__class_obj', class_obj)
+        # Maps not tracking their changes can't be bound
+        object.__setattr__(self, '_InjectorProxy__bind',
+                           bind and getattr(dependencies, 'version', None) is not None)
+        object.__setattr__(self, '_InjectorProxy__cached', (None, None))
 
     def _get_current_object(self):
+        if self.__bind:
+            version, value = self.__cached
+            if version == self.__dependencies.version:
+                return value
+            return self._bind_current_object()
+
         try:
             return self.__dependencies[self.__class_obj]
         except KeyError:
             raise LookupError('Unable to find an instance for {0}'.format(self.__class_obj))
 
+    def _bind_current_object(self):
+        deps = self.__dependencies
+        version = deps.version
+        try:
+            value = deps[self.__class_obj]
+        except KeyError:
+            raise LookupError('Unable to find an instance for {0}'.format(self.__class_obj))
+
+        if deps._is_cacheable(self.__class_obj):
+            object.__setattr__(self, '_InjectorProxy__cached', (version, value))
+        return value
+
     @property
     def __dict__(self):
         return self._get_current_object().__dict__
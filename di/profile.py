@@ -0,0 +1,194 @@
+"""
+Startup profiler for dependency containers
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+
+Imports a module defining a dependency map (and usually the injected code
+using it), timing the imports, every function decorated by an injector along
+with the inspection of its signature and every factory registered. Optionally
+all the singletons are warmed up too, reporting what each one costs to build.
+
+    python -m di.profile myapp.container:dm [--warm] [--json] [--top N]
+
+Times are inclusive, a module importing others or a factory resolving other
+dependencies accounts for them as well.
+"""
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+import functools
+import importlib
+
+try:
+    import builtins
+except ImportError:  # PY2
+    import __builtin__ as builtins
+
+from . import main as di_main
+from .main import timer, DependencyMap
+
+
+def _name(fn):
+    return '{0}.{1}'.format(
+        getattr(fn, '__module__', None) or '?',
+        getattr(fn, '__qualname__', None) or getattr(fn, '__name__', repr(fn)))
+
+
+class Profiler(object):
+    """ Collects the startup costs while installed, as {name: seconds} for
+        every section of the report.
+    """
+    SECTIONS = ('imports', 'decorations', 'inspections', 'factories')
+
+    def __init__(self):
+        for section in self.SECTIONS:
+            setattr(self, section, {})
+        self.injectors = []
+        self._originals = None
+
+    def record(self, section, name, elapsed):
+        values = getattr(self, section)
+        values[name] = values.get(name, 0) + elapsed
+
+    def install(self):
+        """ Monkey patches the import machinery and the injector functions """
+        self._originals = (builtins.__import__, di_main.injector, di_main.get_callable_defaults,
+                           DependencyMap._register)
+        builtins.__import__ = self._import
+        di_main.injector = sys.modules['di'].injector = self._injector
+        di_main.get_callable_defaults = self._get_callable_defaults
+
+        def register(depsmap, key, value, flags=DependencyMap.NONE, *args, **kwargs):
+            if flags & DependencyMap.FACTORY:
+                value = self._factory(key, value)
+            return self._originals[3](depsmap, key, value, flags, *args, **kwargs)
+
+        DependencyMap._register = register
+
+    def uninstall(self):
+        (builtins.__import__, injector, di_main.get_callable_defaults,
+         DependencyMap._register) = self._originals
+        di_main.injector = sys.modules['di'].injector = injector
+
+    def load(self, reference):
+        """ Imports the target given as module:attribute """
+        module_name, _, attrs = reference.partition(':')
+        start = timer()
+        target = importlib.import_module(module_name)
+        self.record('imports', module_name, timer() - start)
+        for attr in filter(None, attrs.split('.')):
+            target = getattr(target, attr)
+        return target
+
+    def _import(self, name, *args, **kwargs):
+        level = args[3] if len(args) > 3 else kwargs.get('level', 0)
+        if level or name in sys.modules:
+            return self._originals[0](name, *args, **kwargs)
+
+        start = timer()
+        try:
+            return self._originals[0](name, *args, **kwargs)
+        finally:
+            if name in sys.modules:
+                self.record('imports', name, timer() - start)
+
+    def _injector(self, *args, **kwargs):
+        inject = self._originals[1](*args, **kwargs)
+        self.injectors.append(inject)
+
+        @functools.wraps(inject)
+        def profiled(fn, *args, **kwargs):
+            start = timer()
+            try:
+                return inject(fn, *args, **kwargs)
+            finally:
+                self.record('decorations', _name(fn), timer() - start)
+
+        return profiled
+
+    def _get_callable_defaults(self, fn, *args, **kwargs):
+        start = timer()
+        try:
+            return self._originals[2](fn, *args, **kwargs)
+        finally:
+            self.record('inspections', _name(fn), timer() - start)
+
+    def _factory(self, key, factory):
+        name = getattr(key, '__name__', None) or repr(key)
+
+        def profiled(deps):
+            start = timer()
+            try:
+                return factory(deps)
+            finally:
+                self.record('factories', name, timer() - start)
+
+        return profiled
+
+    def report(self, top=None):
+        """ Returns the collected costs sorted from the most expensive, with
+            the totals and counts of every section.
+        """
+        report = {}
+        for section in self.SECTIONS:
+            values = getattr(self, section)
+            items = sorted(values.items(), key=lambda item: item[1], reverse=True)
+            report[section] = {
+                'count': len(values),
+                'total': sum(values.values()),
+                'items': [{'name': name, 'seconds': seconds} for name, seconds in items[:top]],
+            }
+        return report
+
+
+def warm(target, injectors):
+    """ Inspects the lazily decorated functions and builds every singleton """
+    for inject in injectors:
+        inject.prepare_all()
+    if isinstance(target, DependencyMap):
+        for key, entry in target._entry_items():
+            if entry.flags & DependencyMap.SINGLETON:
+                target[key]
+
+
+def print_report(report, out=None):
+    out = out or sys.stdout
+    for section in Profiler.SECTIONS:
+        data = report[section]
+        print('{0}: {1} in {2:.1f} ms'.format(section, data['count'], data['total'] * 1000), file=out)
+        for item in data['items']:
+            print('  {0:10.2f} ms  {1}'.format(item['seconds'] * 1000, item['name']), file=out)
+        print(file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m di.profile', description=__doc__.split('\n')[1])
+    parser.add_argument('target', help='dependency map (or module) to import as module:attribute')
+    parser.add_argument('--warm', action='store_true', help='build every singleton')
+    parser.add_argument('--json', action='store_true', help='output the report as JSON')
+    parser.add_argument('--top', type=int, default=20, help='entries reported for each section')
+    args = parser.parse_args(argv)
+
+    profiler = Profiler()
+    profiler.install()
+    try:
+        target = profiler.load(args.target)
+        if args.warm:
+            warm(target, profiler.injectors)
+    finally:
+        profiler.uninstall()
+
+    report = profiler.report(args.top)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Injection for generators and coroutines
+
+:copyright: (c) 2013 by Telefonica I+D.
+:license: see LICENSE for more details.
+
+Injected generators, async generators and coroutines resolve their params
+when they start running instead of when they are created. The scoped
+dependencies they use are held until they are exhausted (or return) and
+released when closed, so a long running stream only holds them while it's
+being consumed.
+
+This module uses Python 3 syntax and is only loaded by the injector when
+needed.
+"""
+import inspect
+import functools
+
+from .main import DependencyScope, _scope_var
+
+
+def _resolve(scope, resolve, args, kwargs):
+    # The scope is only active while resolving, the caller of the generator
+    # must not see it between iterations
+    previous = _scope_var.get()
+    _scope_var.set(scope)
+    try:
+        return resolve(*args, **kwargs)
+    finally:
+        _scope_var.set(previous)
+
+
+def inject(fn, resolve):
+    """ Wraps a generator, async generator or coroutine function, `resolve`
+        returns the keyword arguments with the injected params.
+    """
+    if inspect.isasyncgenfunction(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            scope = DependencyScope()
+            try:
+                generator = fn(*args, **_resolve(scope, resolve, args, kwargs))
+                try:
+                    # Forward the values and exceptions sent by the caller,
+                    # unlike `yield from` async generators need it by hand
+                    item = await generator.__anext__()
+                    while True:
+                        try:
+                            sent = yield item
+                        except GeneratorExit:
+                            raise
+                        except BaseException as e:
+                            item = await generator.athrow(e)
+                        else:
+                            item = await generator.asend(sent)
+                except StopAsyncIteration:
+                    pass
+                finally:
+                    await generator.aclose()
+            finally:
+                scope.close()
+
+    elif inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def inner(*args, **kwargs):
+            scope = DependencyScope()
+            try:
+                return await fn(*args, **_resolve(scope, resolve, args, kwargs))
+            finally:
+                scope.close()
+
+    else:
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            scope = DependencyScope()
+            try:
+                return (yield from fn(*args, **_resolve(scope, resolve, args, kwargs)))
+            finally:
+                scope.close()
+
+    return inner
@@ -14,7 +14,9 @@ from typing import Any
 import unittest
 from pyshould import should
 
-from di import injector, Key
+import pytest
+
+from di import injector, Key, DependencyMap
 
 KeyA = Key('A')
 KeyB = Key('B')
@@ -58,3 +60,126 @@ def test_py3_annotations():
         should.be_a(Qux)
     ))
 
+
+
+class Config: pass
+class Repository:
+    def __init__(self, config: Config):
+        self.config = config
+class Service:
+    def __init__(self, repository: Repository, name: str = Key('name'), retries: int = 3):
+        self.repository = repository
+        self.name = name
+        self.retries = retries
+class Cycle:
+    def __init__(self, other: 'Cycle'):
+        pass
+class Untyped:
+    def __init__(self, config: Config, other):
+        pass
+class Builtins:
+    def __init__(self, count: int, name: str):
+        pass
+class Defaults:
+    def __init__(self, repository=Repository, config: Config = Config):
+        self.repository = repository
+        self.config = config
+
+
+def test_py3_autowire():
+    dm = DependencyMap({Config: Config(), 'name': 'svc'})
+
+    service = dm.autowire(Service)
+    service | should.be_a(Service)
+    service.repository | should.be_a(Repository)
+    service.repository.config | should.be(dm[Config])
+    service.name | should.eq('svc')
+    service.retries | should.eq(3)
+
+    dm[int] = 5
+    dm.autowire(Service).retries | should.eq(5)
+
+
+def test_py3_autowire_reuses_plans():
+    dm = DependencyMap({Config: Config(), 'name': 'svc'})
+    dm.autowire(Service)
+    plans = dict(dm._plans[1])
+    dm.autowire(Service)
+    dm._plans[1] | should.eq(plans)
+
+
+def test_py3_autowire_reports_unresolvable():
+    dm = DependencyMap({Config: Config()})
+    with pytest.raises(LookupError) as exc:
+        dm.autowire(Untyped)
+    str(exc.value) | should.contain_the_substring('other')
+
+    with pytest.raises(LookupError) as exc:
+        dm.autowire(Cycle)
+    str(exc.value) | should.contain_the_substring('circular')
+
+    with pytest.raises(LookupError) as exc:
+        dm.autowire(Builtins)
+    str(exc.value) | should.contain_the_substring('count, name')
+
+
+def test_py3_autowire_class_defaults():
+    dm = DependencyMap({Config: Config()})
+    defaults = dm.autowire(Defaults)
+    defaults.repository | should.be_a(Repository)
+    defaults.config | should.be(dm[Config])
+
+
+def test_py3_async_generator_scope():
+    import asyncio
+    from .test_di import Ham, scoped_setup
+
+    class Test: pass
+    test = Test()
+    scoped_setup(test)
+
+    @test.inject
+    async def rows(count, ham=Ham):
+        for i in range(count):
+            yield ham
+
+    @test.inject
+    async def fetch(ham=Ham):
+        return ham
+
+    async def consume():
+        items = [item async for item in rows(2)]
+        items[0] | should.be(items[1])
+        return items[0], await fetch()
+
+    ham, other = asyncio.run(consume())
+    test.log | should.eq([('acquire', ham), ('release', ham), ('acquire', other), ('release', other)])
+
+
+def test_py3_async_generator_forwards_asend_athrow():
+    import asyncio
+    from .test_di import Ham, scoped_setup
+
+    class Test: pass
+    test = Test()
+    scoped_setup(test)
+
+    @test.inject
+    async def echo(ham=Ham):
+        received = []
+        while True:
+            try:
+                received.append((yield received))
+            except ValueError as e:
+                received.append(str(e))
+
+    async def consume():
+        stream = echo()
+        await stream.asend(None) | should.eq([])
+        await stream.asend('foo') | should.eq(['foo'])
+        await stream.athrow(ValueError('bar')) | should.eq(['foo', 'bar'])
+        with pytest.raises(KeyError):
+            await stream.athrow(KeyError('baz'))
+        [action for action, _ in test.log] | should.eq(['acquire', 'release'])
+
+    asyncio.run(consume())
@@ -3,14 +3,20 @@
 :license: see LICENSE for more details.
 """
 
+import os
 import sys
+import shutil
+import tempfile
 import warnings
 
 import unittest
 import pytest
 from pyshould import should
 
-from di import injector, Key, DependencyMap, ContextualDependencyMap, PatchedDependencyMap, MetaInject
+import di.main
+from di import injector, Key, DependencyMap, ContextualDependencyMap, PatchedDependencyMap, MetaInject, \
+    InjectorDescriptor, inject_class, MetadataCache, resolution_session, enable_events, disable_events, \
+    dependency_scope, ScopeRequired
 
 PY3 = sys.hexversion >= 0x03000000
 PY35 = sys.hexversion >= 0x03050000
@@ -44,6 +50,33 @@ class Eggs(object):
         return self.test_descriptor
 
 
+def lazy_factory(deps):
+    return Ham()
+
+
+bake_inject = injector({Ham: 'HAM'})
+
+
+@bake_inject
+def baked_function(ham=Ham):
+    return ham
+
+
+def pool_factory(deps):
+    return os.getpid()
+
+
+pool_deps = DependencyMap()
+pool_deps.register(Ham, pool_factory, DependencyMap.FACTORY | DependencyMap.SINGLETON)
+pool_deps.register_many({Spam: __name__ + ':pool_factory'})
+pool_inject = injector(DependencyMap())
+
+
+@pool_inject
+def pool_task(value, ham=Ham, spam=Spam):
+    return value, ham, spam
+
+
 class Foo(object):
     DEPS = {}
     inject = injector(DEPS)
@@ -191,6 +224,72 @@ class InjectorMetaclassTests(unittest.TestCase):
             w | should.have_len(0)
 
 
+class InjectorClassWideTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ham = Ham()
+        self.map = DependencyMap({Ham: self.ham})
+        self.inject = injector(self.map)
+
+    def make_class(self, decorate):
+        def init(self, ham=Ham):
+            self.ham = ham
+
+        def echo(self, ham=Ham):
+            return ham
+
+        def nouse(self):
+            pass
+
+        def static(ham=Ham):
+            return ham
+
+        def klass(cls, ham=Ham):
+            return ham
+
+        def getter(self, ham=Ham):
+            return ham
+
+        return decorate('Foo', (object,), {
+            '__init__': init,
+            'echo': echo,
+            'nouse': nouse,
+            'static': staticmethod(static),
+            'klass': classmethod(klass),
+            'prop': property(getter),
+            'Nested': Spam,
+        })
+
+    def assert_injected(self, Foo):
+        Foo.__dict__['nouse'].__name__ | should.eq('nouse')
+        hasattr(Foo.__dict__['nouse'], '__wrapped__') | should.be_False
+        Foo.Nested | should.be(Spam)
+
+        foo = Foo()
+        foo.ham | should.be(self.ham)
+        foo.echo() | should.be(self.ham)
+        foo.echo(ham='bar') | should.eq('bar')
+        foo.static() | should.be(self.ham)
+        Foo.static() | should.be(self.ham)
+        foo.klass() | should.be(self.ham)
+        foo.prop | should.be(self.ham)
+
+    def test_metaclass(self):
+        self.assert_injected(self.make_class(MetaInject(self.inject)))
+
+    def test_class_decorator(self):
+        decorator = inject_class(self.inject)
+        self.assert_injected(self.make_class(lambda *args: decorator(type(*args))))
+
+    def test_shared_cache(self):
+        Foo = self.make_class(MetaInject(self.inject, cache=True))
+        self.assert_injected(Foo)
+
+        other = Ham()
+        self.map[Ham] = other
+        Foo().echo() | should.be(other)
+
+
 class InjectorOverridesTests(unittest.TestCase):
 
     def setUp(self):
@@ -298,6 +397,522 @@ class InjectorPatchTests(unittest.TestCase):
             w[0].category | should.be(UserWarning)
 
 
+class InjectorIsolatedPatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inject = injector({Ham: 'BASE'}, isolate=True)
+
+        @self.inject
+        def test(ham=Ham):
+            return ham
+
+        self.test = test
+
+    def test_patch_unpatch(self):
+        self.inject.patch({Ham: 'PATCHED'})
+        self.test() | should.eql('PATCHED')
+        self.inject.unpatch()
+        self.test() | should.eql('BASE')
+
+        with should.throw(RuntimeError):
+            self.inject.unpatch()
+
+    def test_patch_is_local_to_thread(self):
+        import threading
+        results = []
+
+        def worker():
+            results.append(self.test())
+            self.inject.patch({Ham: 'THREAD'})
+            results.append(self.test())
+
+        self.inject.patch({Ham: 'MAIN'})
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+
+        results | should.eql(['BASE', 'THREAD'])
+        self.test() | should.eql('MAIN')
+        self.inject.unpatch()
+
+
+class InjectorSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap()
+        self.cnt = 0
+
+        @self.map.factory(Ham)
+        def ham(deps):
+            self.cnt += 1
+            return Ham()
+
+        self.inject = injector(self.map, session=True)
+
+    def test_nested_calls_share_factories(self):
+        @self.inject
+        def inner(ham=Ham):
+            return ham
+
+        @self.inject
+        def outer(ham=Ham):
+            return ham, inner(), inner()
+
+        ham, first, second = outer()
+        first | should.be(ham)
+        second | should.be(ham)
+        self.cnt | should.eq(1)
+
+        # A new session is opened on every outermost call
+        outer()[0] | should.not_be(ham)
+        self.cnt | should.eq(2)
+
+    def test_explicit_session(self):
+        @self.inject
+        def foo(ham=Ham):
+            return ham
+
+        with resolution_session():
+            foo() | should.be(foo())
+        foo() | should.not_be(foo())
+
+    def test_disabled_by_default(self):
+        inject = injector(self.map)
+
+        @inject
+        def foo(ham=Ham):
+            return ham
+
+        with resolution_session():
+            foo() | should.not_be(foo())
+
+
+class InjectorMemoizeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap({Ham: Ham()})
+        self.inject = injector(self.map)
+        self.calls = 0
+
+        @self.inject.memoize(maxsize=2)
+        def foo(value, ham=Ham):
+            self.calls += 1
+            return (value, ham)
+
+        self.foo = foo
+
+    def test_memoizes(self):
+        result = self.foo(1)
+        self.foo(1) | should.be(result)
+        self.calls | should.eq(1)
+        self.foo.cache_info() | should.eq((1, 1, 2, 1))
+
+    def test_lru_eviction(self):
+        self.foo(1)
+        self.foo(2)
+        self.foo(1)
+        self.foo(3)
+        self.foo.cache_info().currsize | should.eq(2)
+        self.foo(1)
+        self.calls | should.eq(3)
+        self.foo(2)
+        self.calls | should.eq(4)
+
+    def test_invalidated_on_map_changes(self):
+        self.foo(1)
+        self.map[Ham] = Ham()
+        self.foo(1)[1] | should.be(self.map[Ham])
+        self.calls | should.eq(2)
+
+    def test_invalidated_on_patch(self):
+        self.foo(1)
+        ham = Ham()
+        self.inject.patch({Ham: ham})
+        try:
+            self.foo(1)[1] | should.be(ham)
+        finally:
+            self.inject.unpatch()
+        self.foo(1)[1] | should.be(self.map[Ham])
+        self.calls | should.eq(3)
+
+    def test_explicit_dependency(self):
+        ham = Ham()
+        self.foo(1, ham=ham)[1] | should.be(ham)
+        self.foo(1)[1] | should.be(self.map[Ham])
+        self.calls | should.eq(2)
+
+    def test_cache_clear(self):
+        self.foo(1)
+        self.foo.cache_clear()
+        self.foo(1)
+        self.calls | should.eq(2)
+        self.foo.cache_info() | should.eq((0, 1, 2, 1))
+
+    def test_scoped_dependencies(self):
+        scoped_setup(self)
+
+        @self.inject.memoize()
+        def foo(ham=Ham):
+            # Not released until returning
+            self.log[-1] | should.eq(('acquire', ham))
+            return ham
+
+        ham = foo()
+        self.log | should.eq([('acquire', ham), ('release', ham)])
+        with dependency_scope():
+            foo() | should.not_be(ham)
+
+    def test_events(self):
+        events = []
+
+        @self.inject.memoize()
+        def foo(ham=Ham):
+            return ham
+
+        enable_events(events.append)
+        try:
+            foo()
+        finally:
+            disable_events()
+        injected = [e for e in events if e['event'] == 'inject']
+        injected | should.have_len(1)
+        injected[0]['key'] | should.be(Ham)
+        injected[0]['function'] | should.end_with('.foo')
+
+
+class InjectorEventsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap({Spam: Spam()})
+        self.map.singleton(Ham)(lambda deps: Ham())
+        self.events = []
+
+        @injector(self.map)
+        def foo(ham=Ham, spam=Spam):
+            return ham
+
+        self.foo = foo
+
+    def tearDown(self):
+        disable_events()
+
+    def test_disabled_by_default(self):
+        self.foo()
+        self.events | should.be_empty
+
+    def test_inject_and_factory_events(self):
+        enable_events(self.events.append)
+        self.foo()
+        self.foo()
+
+        factory = [e for e in self.events if e['event'] == 'factory']
+        factory | should.have_len(1)
+        factory[0]['key'] | should.be(Ham)
+        factory[0]['scope'] | should.eq('singleton')
+
+        injected = [e for e in self.events if e['event'] == 'inject' and e['key'] is Ham]
+        [e['hit'] for e in injected] | should.eq([False, True])
+        injected[0]['function'] | should.end_with('.foo')
+        injected[0]['latency'] | should.be_gt(0)
+
+        spam = [e for e in self.events if e['key'] is Spam][0]
+        spam['scope'] | should.eq('value')
+
+    def test_sampling(self):
+        self.map[Ham]
+        enable_events(self.events.append, every=2)
+        for _ in range(4):
+            self.foo()
+        len([e for e in self.events if e['event'] == 'inject']) | should.eq(4)
+
+    def test_rate_limit(self):
+        enable_events(self.events.append, rate=0.001, burst=1)
+        for _ in range(4):
+            self.foo()
+        len([e for e in self.events if e['event'] == 'inject']) | should.eq(2)
+
+    def test_disable_at_runtime(self):
+        enable_events(self.events.append)
+        self.foo()
+        disable_events()
+        count = len(self.events)
+        self.foo()
+        len(self.events) | should.eq(count)
+
+
+def scoped_setup(test):
+    test.map = DependencyMap()
+    test.log = []
+
+    @test.map.scoped(Ham)
+    def ham(deps):
+        ham = Ham()
+        test.log.append(('acquire', ham))
+        yield ham
+        test.log.append(('release', ham))
+
+    test.inject = injector(test.map)
+
+
+class InjectorScopedTests(unittest.TestCase):
+
+    def setUp(self):
+        scoped_setup(self)
+
+    def test_requires_scope(self):
+        with pytest.raises(ScopeRequired):
+            self.map[Ham]
+
+    def test_released_when_returning(self):
+        @self.inject
+        def inner(ham=Ham):
+            return ham
+
+        @self.inject
+        def foo(ham=Ham):
+            self.log | should.have_len(1)
+            inner() | should.be(ham)
+            return ham
+
+        ham = foo()
+        self.log | should.eq([('acquire', ham), ('release', ham)])
+
+    def test_explicit_scope(self):
+        with dependency_scope():
+            ham = self.map[Ham]
+            self.map[Ham] | should.be(ham)
+            self.log | should.have_len(1)
+        self.log | should.have_len(2)
+
+    def test_released_on_error(self):
+        @self.inject
+        def foo(ham=Ham):
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            foo()
+        [action for action, _ in self.log] | should.eq(['acquire', 'release'])
+
+    @pytest.mark.skipif(not PY3, reason='requires python 3.x')
+    def test_generator_acquires_on_first_next(self):
+        @self.inject
+        def rows(count, ham=Ham):
+            for i in range(count):
+                yield i, ham
+
+        stream = rows(2)
+        self.log | should.be_empty
+        i, ham = next(stream)
+        self.log | should.eq([('acquire', ham)])
+        next(stream)
+        with pytest.raises(StopIteration):
+            next(stream)
+        self.log | should.eq([('acquire', ham), ('release', ham)])
+
+    @pytest.mark.skipif(not PY3, reason='requires python 3.x')
+    def test_generator_released_on_close(self):
+        @self.inject
+        def rows(ham=Ham):
+            while True:
+                yield ham
+
+        stream = rows()
+        ham = next(stream)
+        stream.close()
+        self.log | should.eq([('acquire', ham), ('release', ham)])
+
+        # Not visible to the caller between iterations
+        stream = rows()
+        next(stream)
+        with pytest.raises(ScopeRequired):
+            self.map[Ham]
+        stream.close()
+
+    def test_not_kept_by_sessions(self):
+        inject = injector(self.map, session=True)
+
+        @inject
+        def foo(ham=Ham):
+            return ham
+
+        with resolution_session():
+            with dependency_scope():
+                first = foo()
+            with dependency_scope():
+                foo() | should.not_be(first)
+
+    def test_not_cached_by_descriptors(self):
+        class Subject(object):
+            ham = self.map(Ham, cache=True)
+
+        subject = Subject()
+        with dependency_scope():
+            first = subject.ham
+            subject.ham | should.be(first)
+        with dependency_scope():
+            subject.ham | should.not_be(first)
+        self.map._is_cacheable(Ham) | should.be_False
+
+
+class InjectorLazyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.inject = injector({Ham: 'HAM'}, lazy=True)
+
+    def test_inspects_on_first_call(self):
+        @self.inject
+        def test(ham=Ham):
+            return ham
+
+        self.inject.prepare_all | should.be_callable
+        test() | should.eq('HAM')
+        self.inject.prepare_all() | should.eq(0)
+
+    def test_prepare_all(self):
+        @self.inject
+        def foo(ham=Ham):
+            return ham
+
+        @self.inject
+        def bar(ham=Ham):
+            return ham
+
+        self.inject.prepare_all() | should.eq(2)
+        self.inject.prepare_all() | should.eq(0)
+        foo() | should.eq('HAM')
+        bar() | should.eq('HAM')
+
+    def test_does_not_keep_functions_alive(self):
+        import gc
+        import weakref
+
+        def foo(ham=Ham):
+            return ham
+
+        ref = weakref.ref(foo)
+        wrapped = weakref.ref(self.inject(foo))
+        del foo
+        gc.collect()
+        ref() | should.be_None
+        wrapped() | should.be_None
+        self.inject.prepare_all() | should.eq(0)
+
+    def test_warns_when_prepared(self):
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+
+            foo = self.inject(lambda: True)
+            w | should.have_len(0)
+
+            foo() | should.be_True
+            w | should.have_len(1)
+
+
+class InjectorMetadataCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_function(self, default):
+        def foo(a, ham=Ham, spam=default):
+            return ham, spam
+        return foo
+
+    def test_persists_across_instances(self):
+        inject = injector({Ham: 'HAM', Spam: 'SPAM'}, cache_dir=self.path)
+        inject(self.make_function(Spam))(1) | should.eql(('HAM', 'SPAM'))
+        MetadataCache.for_path(self.path).save()
+
+        cache = MetadataCache(self.path)
+        original = di.main.get_callable_defaults
+        di.main.get_callable_defaults = None
+        try:
+            cache.get_injectables(self.make_function(Spam)) | should.eql({'ham': Ham, 'spam': Spam})
+            # Defaults are read from the live function
+            cache.get_injectables(self.make_function(None)) | should.eql({'ham': Ham})
+        finally:
+            di.main.get_callable_defaults = original
+
+    def test_invalidated_when_code_changes(self):
+        cache = MetadataCache(self.path)
+        cache.get_injectables(self.make_function(Spam))
+
+        def foo(ham=Spam):
+            pass
+        foo.__qualname__ = self.make_function(Spam).__qualname__
+
+        cache.get_injectables(foo) | should.eql({'ham': Spam})
+
+
+class InjectorBakeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap({Ham: 'HAM'})
+        self.inject = injector(self.map)
+        self.cnt = 0
+
+    def test_bake(self):
+        @self.inject
+        def test(a, ham=Ham, *args, **kwargs):
+            return ham
+
+        self.inject.bake() | should.eq(1)
+        test.__wrapped__.__defaults__ | should.eql(('HAM',))
+        test(1) | should.eq('HAM')
+        test(1, ham='OTHER') | should.eq('OTHER')
+
+        self.inject.unbake()
+        test.__wrapped__.__defaults__ | should.eql((Ham,))
+        self.map[Ham] = 'NEW'
+        test(1) | should.eq('NEW')
+
+    def test_factories_are_not_baked(self):
+        @self.map.factory(Spam)
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+        @self.inject
+        def test(spam=Spam):
+            return spam
+
+        self.inject.bake() | should.eq(0)
+        test() | should.eq(1)
+        test() | should.eq(2)
+
+    def test_patch_bakes_again(self):
+        @self.inject
+        def test(ham=Ham):
+            return ham
+
+        self.inject.bake()
+        self.inject.patch({Ham: 'PATCHED'})
+        test() | should.eq('PATCHED')
+        self.inject.unpatch()
+        test() | should.eq('HAM')
+
+        self.inject.patch({})
+        test.__wrapped__.__defaults__ | should.eql((Ham,))
+        with should.throw(LookupError):
+            test()
+        self.inject.unpatch()
+        self.inject.unbake()
+
+    def test_rebinds_module_functions(self):
+        wrapped = baked_function
+        bake_inject.bake()
+        try:
+            module = sys.modules[__name__]
+            module.baked_function | should.be(wrapped.__wrapped__)
+            module.baked_function() | should.eq('HAM')
+        finally:
+            bake_inject.unbake()
+
+        sys.modules[__name__].baked_function | should.be(wrapped)
+
 
 class InjectorKeyTests(unittest.TestCase):
 
@@ -330,6 +945,33 @@ class InjectorKeyTests(unittest.TestCase):
 
         foo() | should.eq('SELF-FOO')
 
+    def test_keys_are_interned(self):
+        Key('foo') | should.be(Key('foo'))
+        Key(dict, 'foo') | should.be(Key((dict, 'foo')))
+        Key('foo') | should.not_be(Key('bar'))
+
+    def test_keys_keep_the_value_type(self):
+        keys = [Key(1), Key(True), Key(1.0)]
+        [type(key.value) for key in keys] | should.eq([int, bool, float])
+        keys[0] | should.not_be(keys[1])
+        keys[0] | should.eq(keys[2])
+        Key(1.0) | should.be(keys[2])
+
+    def test_key_equals_its_value(self):
+        key = Key('foo')
+        key | should.eq('foo')
+        hash(key) | should.eq(hash('foo'))
+        key | should.not_eq(Key('bar'))
+
+    def test_key_pickles(self):
+        import pickle
+        pickle.loads(pickle.dumps(Key('foo'))) | should.be(Key('foo'))
+
+    def test_unhashable_key(self):
+        key = Key(['foo'])
+        key.value | should.eq(['foo'])
+        key | should.not_be(Key(['foo']))
+
 
 class DependencyMapTests(unittest.TestCase):
 
@@ -381,6 +1023,170 @@ class DependencyMapTests(unittest.TestCase):
         t1.join()
         self.cnt | should.eq(2)
 
+    def test_singleton_built_once_by_concurrent_threads(self):
+        import time
+        import threading
+
+        @self.map.singleton('foo')
+        def fn(deps):
+            self.cnt += 1
+            time.sleep(0.01)
+            return Ham()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.map['foo'])) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.cnt | should.eq(1)
+        len(set(id(r) for r in results)) | should.eq(1)
+
+    def test_register_thread_with_class_key(self):
+        @self.map.thread(Ham)
+        def fn(deps):
+            return Ham()
+
+        self.map[Ham] | should.be(self.map[Ham])
+
+    def test_context_manager_restores_singletons(self):
+        @self.map.singleton('foo')
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+        with self.map:
+            self.map['foo'] | should.eq(1)
+            self.map['bar'] = 'BAR'
+        'bar' | should.not_be_in(self.map)
+        self.map['foo'] | should.eq(2)
+
+    def test_register_weak(self):
+        @self.map.weak('foo')
+        def fn(deps):
+            self.cnt += 1
+            return Ham()
+
+        ham = self.map['foo']
+        self.map['foo'] | should.be(ham)
+        self.cnt | should.eq(1)
+
+        # Once released it's built again
+        del ham
+        import gc
+        gc.collect()
+        self.map['foo'] | should.be_a(Ham)
+        self.cnt | should.eq(2)
+
+    def test_register_weak_not_cacheable(self):
+        self.map.weak(Ham)(lambda deps: Ham())
+        self.map._is_cacheable(Ham) | should.be_False
+
+    def test_register_weak_requires_weakrefs(self):
+        self.map.weak('foo')(lambda deps: {})
+        with pytest.raises(TypeError):
+            self.map['foo']
+
+    def test_register_process(self):
+        @self.map.process('foo')
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+        self.map['foo'] | should.eq(1)
+        self.map['foo'] | should.eq(1)
+
+        # Simulate running in a forked process
+        pid = di.main._pid[0]
+        di.main._pid[0] = -1
+        try:
+            self.map['foo'] | should.eq(2)
+            self.map['foo'] | should.eq(2)
+        finally:
+            di.main._pid[0] = pid
+        self.map['foo'] | should.eq(3)
+
+    @pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='requires os.register_at_fork')
+    def test_process_after_fork(self):
+        disposed = []
+
+        @self.map.process('pid', dispose=disposed.append)
+        def fn(deps):
+            return os.getpid()
+
+        self.map['pid'] | should.eq(os.getpid())
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.write(wfd, str(self.map['pid']).encode('ascii'))
+            os._exit(0)
+
+        os.close(wfd)
+        child_value = int(os.read(rfd, 32))
+        os.close(rfd)
+        os.waitpid(pid, 0)
+
+        child_value | should.eq(pid)
+        disposed | should.eql([os.getpid()])
+        self.map['pid'] | should.eq(os.getpid())
+
+    @pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='requires os.register_at_fork')
+    def test_fork_while_building(self):
+        import select
+        import signal
+        import threading
+        building, release = threading.Event(), threading.Event()
+
+        @self.map.singleton('slow')
+        def slow(deps):
+            if not building.is_set():
+                building.set()
+                release.wait()
+            return os.getpid()
+
+        t = threading.Thread(target=lambda: self.map['slow'])
+        t.start()
+        try:
+            building.wait()
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.write(wfd, str(self.map['slow']).encode('ascii'))
+                os._exit(0)
+        finally:
+            release.set()
+            t.join()
+
+        os.close(wfd)
+        ready, _, _ = select.select([rfd], [], [], 10)
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+        child_value = int(os.read(rfd, 32)) if ready else None
+        os.close(rfd)
+        os.waitpid(pid, 0)
+
+        child_value | should.eq(pid)
+
+    def test_preload_for_fork(self):
+        built = []
+
+        @self.map.singleton('safe', fork_safe=True)
+        def safe(deps):
+            built.append('safe')
+            return {}
+
+        @self.map.singleton('unsafe')
+        def unsafe(deps):
+            built.append('unsafe')
+            return {}
+
+        self.map.preload_for_fork(freeze=False) | should.eql(['safe'])
+        built | should.eql(['safe'])
+        self.map['safe'] | should.eql({})
+        built | should.eql(['safe'])
+
     def test_dependencies_passed_as_arg(self):
         self.map.register('dep', 'DEP')
 
@@ -407,6 +1213,568 @@ class DependencyMapTests(unittest.TestCase):
         func() | should.eql( 30 )
 
 
+class DependencyMapInheritTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap()
+        self.map.inherit = True
+
+    def test_disabled_by_default(self):
+        dm = DependencyMap({Ham: 'HAM'})
+        SubHam = type('SubHam', (Ham,), {})
+        SubHam | should.not_be_in(dm)
+        with pytest.raises(KeyError):
+            dm[SubHam]
+
+    def test_resolves_base_class(self):
+        SubHam = type('SubHam', (Ham,), {})
+        self.map[Ham] = 'HAM'
+        self.map[SubHam] | should.eq('HAM')
+        SubHam | should.be_in(self.map)
+
+    def test_resolves_most_specific_base(self):
+        SubHam = type('SubHam', (Ham,), {})
+        SubSubHam = type('SubSubHam', (SubHam,), {})
+        self.map[object] = 'OBJECT'
+        self.map[Ham] = 'HAM'
+        self.map[SubHam] = 'SUBHAM'
+        self.map[SubSubHam] | should.eq('SUBHAM')
+
+    def test_resolves_abc(self):
+        try:
+            from collections.abc import Mapping
+        except ImportError:
+            from collections import Mapping
+        self.map[Mapping] = 'MAPPING'
+        self.map[dict] | should.eq('MAPPING')
+
+    def test_memoized_until_modified(self):
+        SubHam = type('SubHam', (Ham,), {})
+        self.map[Ham] = 'HAM'
+        self.map[SubHam] | should.eq('HAM')
+        self.map._bases[1] | should.eq({SubHam: Ham})
+
+        self.map[SubHam] = 'SUBHAM'
+        self.map[SubHam] | should.eq('SUBHAM')
+
+    def test_factories(self):
+        SubHam = type('SubHam', (Ham,), {})
+        self.map.singleton(Ham)(lambda deps: Ham())
+        self.map[SubHam] | should.be(self.map[Ham])
+        self.map._is_cacheable(SubHam) | should.be_True
+
+    def test_resolves_first_base_in_mro(self):
+        HamSpam = type('HamSpam', (Ham, Spam), {})
+        self.map[Ham] = 'HAM'
+        self.map[Spam] = 'SPAM'
+        self.map[HamSpam] | should.eq('HAM')
+
+    def test_ambiguous(self):
+        try:
+            from collections.abc import Container, Sized
+        except ImportError:
+            from collections import Container, Sized
+        self.map[Container] = 'CONTAINER'
+        self.map[Sized] = 'SIZED'
+        with pytest.raises(LookupError) as exc:
+            self.map[dict]
+        str(exc.value) | should.contain_the_substring('Ambiguous')
+        (dict in self.map) | should.be_False
+        (dict in self.map.pin()) | should.be_False
+
+    def test_contains_unhashable(self):
+        ([] in self.map) | should.be_False
+
+    def test_injector(self):
+        SubHam = type('SubHam', (Ham,), {})
+        self.map[Ham] = 'HAM'
+        inject = injector(self.map)
+
+        @inject
+        def foo(ham=SubHam):
+            return ham
+
+        foo() | should.eq('HAM')
+
+
+class DependencyMapLazyFactoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap()
+
+    def test_register_many(self):
+        self.map.register_many({
+            'lazy': __name__ + ':lazy_factory',
+            'single': (__name__ + ':lazy_factory', DependencyMap.SINGLETON),
+            'callable': lambda deps: 'CALLABLE',
+        })
+
+        self.map.import_timings() | should.eql({})
+        self.map['lazy'] | should.be_a(Ham)
+        self.map['lazy'] | should.not_be(self.map['lazy'])
+        self.map['callable'] | should.eq('CALLABLE')
+        self.map['single'] | should.be(self.map['single'])
+
+        timings = self.map.import_timings()
+        sorted(timings.keys()) | should.eql(['lazy', 'single'])
+
+    def test_invalid_reference(self):
+        with should.throw(ValueError):
+            self.map.register_many({'foo': 'tests.test_di.lazy_factory'})
+
+        self.map.register_many({'foo': 'tests.missing_module:factory'})
+        with should.throw(ImportError):
+            self.map['foo']
+
+
+@pytest.mark.skipif(sys.hexversion < 0x03080000, reason='requires multiprocessing.shared_memory')
+class DependencyMapSharedTests(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'di_test_{0}_{1}'.format(os.getpid(), id(self))
+        self.calls = []
+
+    def make_map(self):
+        dm = DependencyMap()
+
+        @dm.shared('blob', name=self.name)
+        def blob(deps):
+            self.calls.append(True)
+            return bytearray(b'shared data')
+
+        return dm
+
+    def test_attaches_existing_segment(self):
+        creator, other = self.make_map(), self.make_map()
+        try:
+            creator['blob'].tobytes() | should.eq(b'shared data')
+            creator['blob'].readonly | should.be_True
+            other['blob'].tobytes() | should.eq(b'shared data')
+            self.calls | should.have_len(1)
+        finally:
+            other.close_shared()
+            creator.close_shared()
+
+    def test_unlinks_on_close(self):
+        dm = self.make_map()
+        dm['blob']
+        dm.close_shared()
+
+        dm = self.make_map()
+        dm['blob'].tobytes() | should.eq(b'shared data')
+        dm.close_shared()
+        self.calls | should.have_len(2)
+
+    @pytest.mark.skipif(os.name != 'posix', reason='requires POSIX shared memory')
+    def test_waits_for_the_segment_to_be_sized(self):
+        import mmap
+        import threading
+        import _posixshmem
+        # Created by another process which didn't size it yet
+        fd = _posixshmem.shm_open('/' + self.name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        dm = self.make_map()
+
+        def fill():
+            data = bytearray(b'other data')
+            os.ftruncate(fd, di.main._SEGMENT_HEADER.size + len(data))
+            buf = mmap.mmap(fd, 0)
+            buf[di.main._SEGMENT_HEADER.size:] = data
+            di.main._SEGMENT_HEADER.pack_into(buf, 0, len(data), 1, os.getpid())
+            buf.close()
+            os.close(fd)
+
+        timer = threading.Timer(0.05, fill)
+        timer.start()
+        try:
+            dm['blob'].tobytes() | should.eq(b'other data')
+            self.calls | should.have_len(0)
+        finally:
+            timer.join()
+            dm.close_shared()
+            _posixshmem.shm_unlink('/' + self.name)
+
+    @pytest.mark.skipif(os.name != 'posix', reason='requires POSIX shared memory')
+    def test_rebuilds_abandoned_segment(self):
+        # Created by a process that exited before filling it
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        abandoned = di.main._open_segment(self.name, create=True, size=64)
+        di.main._SEGMENT_HEADER.pack_into(abandoned.buf, 0, 0, 0, pid)
+        abandoned.close()
+
+        dm = self.make_map()
+        try:
+            dm['blob'].tobytes() | should.eq(b'shared data')
+            self.calls | should.have_len(1)
+        finally:
+            dm.close_shared()
+
+    @pytest.mark.skipif(os.name != 'posix', reason='requires POSIX shared memory')
+    def test_rebuilds_unsized_segment_after_timeout(self):
+        import _posixshmem
+        fd = _posixshmem.shm_open('/' + self.name, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        os.close(fd)
+        timeout, di.main.SEGMENT_TIMEOUT = di.main.SEGMENT_TIMEOUT, 0.05
+
+        dm = self.make_map()
+        try:
+            dm['blob'].tobytes() | should.eq(b'shared data')
+            self.calls | should.have_len(1)
+        finally:
+            di.main.SEGMENT_TIMEOUT = timeout
+            dm.close_shared()
+
+    def test_factory_resolves_from_the_pinned_table(self):
+        dm = DependencyMap({'data': b'shared data'})
+        inject = injector(dm)
+
+        @dm.factory('publish')
+        def publish(deps):
+            # Published while the call resolves its params
+            with dm.transaction() as tx:
+                tx['data'] = b'other data'
+
+        @dm.shared('blob', name=self.name)
+        def blob(deps):
+            return bytearray(deps['data'])
+
+        @inject
+        def fn(publish=Key('publish'), blob=Key('blob')):
+            return blob.tobytes()
+
+        try:
+            fn() | should.eq(b'shared data')
+        finally:
+            dm.close_shared()
+
+
+class DependencyMapSpecTests(unittest.TestCase):
+
+    def test_spec_keeps_inherit(self):
+        import pickle
+
+        dm = DependencyMap({Ham: 'HAM'})
+        dm.inherit = True
+        dm = pickle.loads(pickle.dumps(dm.spec())).build()
+        dm.inherit | should.be_True
+        dm[type('SubHam', (Ham,), {})] | should.eq('HAM')
+
+    def test_spec_is_picklable(self):
+        import pickle
+
+        spec = pickle.loads(pickle.dumps(pool_deps.spec()))
+        dm = spec.build()
+        dm | should.be_a(DependencyMap)
+        dm[Ham] | should.eq(os.getpid())
+        dm[Ham] | should.be(dm[Ham])
+        dm[Spam] | should.eq(os.getpid())
+
+    @pytest.mark.skipif(sys.hexversion < 0x03070000, reason='requires ProcessPoolExecutor initializer')
+    def test_process_pool(self):
+        from di.futures import InjectorPoolExecutor
+
+        with InjectorPoolExecutor(pool_deps, max_workers=1) as executor:
+            results = list(executor.map(pool_task, [1, 2]))
+
+        results[0][0] | should.eq(1)
+        results[0][1] | should.not_eq(os.getpid())
+        results[1][1] | should.eq(results[0][1])
+        results[1][2] | should.eq(results[0][1])
+
+        with InjectorPoolExecutor(pool_deps.spec(), max_workers=1) as executor:
+            executor.submit(pool_task, 3, spam='SPAM').result()[2] | should.eq('SPAM')
+
+
+class DependencyMapPersistTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cnt = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_map(self, version=1):
+        dm = DependencyMap()
+        dm.cache_dir = self.path
+
+        @dm.singleton('rules', persist='rules', version=version)
+        def rules(deps):
+            self.cnt += 1
+            return {'rules': [1, 2, 3]}
+
+        return dm
+
+    def test_loads_persisted(self):
+        self.make_map()['rules'] | should.eql({'rules': [1, 2, 3]})
+        self.make_map()['rules'] | should.eql({'rules': [1, 2, 3]})
+        self.cnt | should.eq(1)
+
+        self.make_map(version=2)['rules']
+        self.cnt | should.eq(2)
+
+    def test_rebuilds_when_corrupt(self):
+        self.make_map()['rules']
+        filename = os.path.join(self.path, 'rules-1.pickle')
+        with open(filename, 'r+b') as fd:
+            fd.seek(-1, os.SEEK_END)
+            fd.write(b'X')
+
+        self.make_map()['rules'] | should.eql({'rules': [1, 2, 3]})
+        self.cnt | should.eq(2)
+        self.make_map()['rules']
+        self.cnt | should.eq(2)
+
+
+class DependencyMapSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap()
+        self.cnt = 0
+
+    def test_restores_values_and_flags(self):
+        self.map['foo'] = 'FOO'
+        state = self.map.snapshot()
+
+        self.map['foo'] = 'BAR'
+        self.map.register('bar', lambda deps: 'BAR', DependencyMap.FACTORY)
+        self.map['bar'] | should.eq('BAR')
+
+        self.map.restore(state)
+        self.map['foo'] | should.eq('FOO')
+        ('bar' in self.map) | should.be_False
+
+        # States can be restored multiple times
+        self.map['foo'] = 'BAZ'
+        self.map.restore(state)
+        self.map['foo'] | should.eq('FOO')
+
+    def test_restores_singletons(self):
+        @self.map.singleton('foo')
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+        state = self.map.snapshot()
+        self.map['foo'] | should.eq(1)
+        self.map.restore(state)
+        self.map['foo'] | should.eq(2)
+        self.map['foo'] | should.eq(2)
+
+    def test_building_does_not_copy_the_registrations(self):
+        self.map.singleton('foo')(lambda deps: Ham())
+        self.map.thread('bar')(lambda deps: Spam())
+        table = self.map._table
+
+        state = self.map.snapshot()
+        foo, bar = self.map['foo'], self.map['bar']
+        self.map._table | should.be(table)
+        self.map['foo'] | should.be(foo)
+        self.map['bar'] | should.be(bar)
+
+        self.map.restore(state)
+        self.map['foo'] | should.not_be(foo)
+        self.map['bar'] | should.not_be(bar)
+
+    def test_writing_does_not_copy_the_registrations(self):
+        self.map.singleton('foo')(lambda deps: Ham())
+        entries = self.map._table[0]
+        foo = self.map['foo']
+
+        state = self.map.snapshot()
+        self.map.singleton('foo')(lambda deps: Spam())
+        self.map['bar'] = 'BAR'
+        self.map._table[0] | should.be(entries)
+        self.map['foo'] | should.be_a(Spam)
+
+        nested = self.map.snapshot()
+        self.map['bar'] = 'BAZ'
+        self.map.restore(nested)
+        self.map['bar'] | should.eq('BAR')
+
+        self.map.restore(state)
+        self.map['foo'] | should.be(foo)
+        ('bar' in self.map) | should.be_false()
+
+    def test_keeps_the_instances_of_other_threads(self):
+        import threading
+        self.map.thread(Ham)(lambda deps: Ham())
+        requests, results = [], []
+        ready, done = threading.Event(), threading.Event()
+
+        def worker():
+            while True:
+                ready.wait()
+                ready.clear()
+                if not requests.pop():
+                    return
+                results.append(self.map[Ham])
+                done.set()
+
+        def resolve_in_worker():
+            done.clear()
+            requests.append(True)
+            ready.set()
+            done.wait()
+            return results[-1]
+
+        t = threading.Thread(target=worker)
+        t.start()
+        try:
+            ham = resolve_in_worker()
+            state = self.map.snapshot()
+            self.map['foo'] = 'FOO'
+            self.map[Ham] | should.not_be(ham)
+            resolve_in_worker() | should.be(ham)
+            self.map.restore(state)
+            resolve_in_worker() | should.be(ham)
+        finally:
+            requests.append(False)
+            ready.set()
+            t.join()
+
+    def test_restores_contexts(self):
+        cmap = ContextualDependencyMap()
+        cmap['foo'] = 'ROOT'
+        cmap.context('A')
+        cmap['foo'] = 'A'
+        state = cmap.snapshot()
+
+        cmap['foo'] = 'A2'
+        cmap.context('B')
+        cmap['foo'] = 'B'
+
+        cmap.restore(state)
+        cmap['foo'] | should.eq('A')
+        cmap.context(None)
+        cmap['foo'] | should.eq('ROOT')
+        cmap.context('B')
+        cmap['foo'] | should.eq('ROOT')
+
+    def test_restores_contexts_with_inherit(self):
+        SubHam = type('SubHam', (Ham,), {})
+        cmap = ContextualDependencyMap({Ham: 'HAM'})
+        cmap.inherit = True
+        cmap.context('A')
+        state = cmap.snapshot()
+
+        cmap.reset()
+        cmap.restore(state)
+        cmap[SubHam] | should.eq('HAM')
+
+
+class DependencyMapTransactionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap({'foo': 'FOO', 'bar': 'BAR'})
+
+    def test_publishes_on_exit(self):
+        with self.map.transaction() as tx:
+            tx['foo'] = 'FOO2'
+            tx['bar'] = 'BAR2'
+            tx['foo'] | should.eq('FOO2')
+            self.map['foo'] | should.eq('FOO')
+        self.map['foo'] | should.eq('FOO2')
+        self.map['bar'] | should.eq('BAR2')
+
+    def test_discards_on_error(self):
+        with pytest.raises(ValueError):
+            with self.map.transaction() as tx:
+                tx['foo'] = 'FOO2'
+                raise ValueError()
+        self.map['foo'] | should.eq('FOO')
+
+    def test_bumps_version(self):
+        version = self.map.version
+        with self.map.transaction() as tx:
+            tx['foo'] = 'FOO2'
+        self.map.version | should.not_eq(version)
+
+    def test_keeps_built_singletons(self):
+        self.map.singleton(Ham)(lambda deps: Ham())
+        with self.map.transaction() as tx:
+            tx['foo'] = 'FOO2'
+            # Built by a reader while the transaction is open
+            ham = self.map[Ham]
+        self.map[Ham] | should.be(ham)
+
+    def test_replaced_singletons_are_built_again(self):
+        self.map.singleton(Ham)(lambda deps: Ham())
+        ham = self.map[Ham]
+        with self.map.transaction() as tx:
+            tx.singleton(Ham)(lambda deps: Ham())
+        self.map[Ham] | should.not_be(ham)
+
+    def test_keeps_thread_instances(self):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        self.map.thread(Ham)(lambda deps: Ham())
+        requests, results = queue.Queue(), queue.Queue()
+
+        def worker():
+            while requests.get():
+                results.put(self.map[Ham])
+
+        t = threading.Thread(target=worker)
+        t.start()
+        try:
+            requests.put(True)
+            ham = results.get(timeout=5)
+            with self.map.transaction() as tx:
+                tx['foo'] = 'FOO2'
+            self.map._shared | should.be_false()
+            self.map['bar'] = 'BAR2'
+            requests.put(True)
+            results.get(timeout=5) | should.be(ham)
+        finally:
+            requests.put(False)
+            t.join()
+
+    def test_contextual_map(self):
+        cmap = ContextualDependencyMap({'foo': 'FOO'})
+        with cmap.transaction() as tx:
+            tx['foo'] = 'FOO2'
+        cmap['foo'] | should.eq('FOO2')
+
+        cmap.context('A')
+        with cmap.transaction() as tx:
+            tx['foo'] = 'A'
+        cmap['foo'] | should.eq('A')
+        cmap.context(None)
+        cmap['foo'] | should.eq('FOO2')
+
+    def test_injected_calls_resolve_from_a_single_table(self):
+        @self.map.factory('publish')
+        def publish(deps):
+            # Published while the call resolves its params
+            with self.map.transaction() as tx:
+                tx['foo'] = 'FOO2'
+                tx['bar'] = 'BAR2'
+            return deps['foo']
+
+        inject = injector(self.map)
+
+        @inject
+        def fn(publish=Key('publish'), bar=Key('bar')):
+            return publish, bar
+
+        fn() | should.eql(('FOO', 'BAR'))
+        fn() | should.eql(('FOO2', 'BAR2'))
+
+    def test_pin(self):
+        deps = self.map.pin()
+        with self.map.transaction() as tx:
+            tx['foo'] = 'FOO2'
+        deps['foo'] | should.eq('FOO')
+        ('bar' in deps) | should.be_True
+        self.map['foo'] | should.eq('FOO2')
+
+
 class DependencyMapDescriptorTests(unittest.TestCase):
 
     def test_acts_as_descriptor(self):
@@ -426,6 +1794,88 @@ class DependencyMapDescriptorTests(unittest.TestCase):
         subject.ham | should.be_None
 
 
+class DependencyMapCachedDescriptorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map = DependencyMap()
+        self.cnt = 0
+
+        @self.map.factory(Spam)
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+    def test_caches_singleton_in_descriptor(self):
+        self.map[Ham] = 'HAM'
+
+        class Subject(object):
+            ham = self.map(Ham, cache=True)
+
+        Subject().ham | should.eq('HAM')
+        Subject.__dict__['ham']._cached | should.eql((self.map.version, 'HAM'))
+
+        self.map[Ham] = 'HAM2'
+        Subject().ham | should.eq('HAM2')
+
+    def test_caches_factory_in_instance(self):
+        class Subject(object):
+            spam = self.map(Spam, cache=True)
+
+        one, two = Subject(), Subject()
+        one.spam | should.eq(1)
+        one.spam | should.eq(1)
+        two.spam | should.eq(2)
+
+        self.map['other'] = True
+        one.spam | should.eq(3)
+
+    def test_process_and_thread_not_cached_in_instance(self):
+        import threading
+
+        self.map.process('process')(lambda deps: Ham())
+        self.map.thread('thread')(lambda deps: Ham())
+
+        class Subject(object):
+            process = self.map('process', cache=True)
+            thread = self.map('thread', cache=True)
+
+        subject = Subject()
+        ham = subject.process
+        subject.process | should.be(ham)
+
+        # Simulate running in a forked process
+        pid = di.main._pid[0]
+        di.main._pid[0] = -1
+        try:
+            subject.process | should.not_be(ham)
+        finally:
+            di.main._pid[0] = pid
+
+        ham = subject.thread
+        other = []
+        thread = threading.Thread(target=lambda: other.append(subject.thread))
+        thread.start()
+        thread.join()
+        other[0] | should.not_be(ham)
+        subject.thread | should.be(ham)
+
+    def test_slots(self):
+        class Subject(object):
+            __slots__ = InjectorDescriptor.slots('spam')
+            spam = self.map(Spam, cache=True)
+
+        class Broken(object):
+            __slots__ = ()
+            spam = self.map(Spam, cache=True)
+
+        subject = Subject()
+        subject.spam | should.eq(1)
+        subject.spam | should.eq(1)
+
+        with should.throw(TypeError):
+            Broken().spam
+
+
 class DependencyMapProxyTests(unittest.TestCase):
 
     def test_acts_as_proxy(self):
@@ -472,6 +1922,41 @@ class DependencyMapProxyTests(unittest.TestCase):
         with should.throw(LookupError):
             l.foo()
 
+    def test_proxy_has_no_dict_slot(self):
+        dm = DependencyMap()
+        dm[Ham] = Ham()
+        dm[Ham].foo = 'FOO'
+
+        proxy = dm.proxy(Ham)
+        proxy.__dict__ | should.eql({'foo': 'FOO'})
+        with should.throw(AttributeError):
+            object.__setattr__(proxy, 'bar', 'BAR')
+
+    def test_bound_proxy(self):
+        dm = DependencyMap()
+        ham = Ham()
+        dm[Ham] = ham
+
+        proxy = dm.proxy(Ham, bind=True)
+        proxy._get_current_object() | should.be(ham)
+        proxy._InjectorProxy__cached | should.eql((dm.version, ham))
+
+        dm[Ham] = Spam()
+        proxy._get_current_object() | should.be_a(Spam)
+
+    def test_bound_proxy_factory(self):
+        self.cnt = 0
+        dm = DependencyMap()
+
+        @dm.factory(Ham)
+        def fn(deps):
+            self.cnt += 1
+            return self.cnt
+
+        proxy = dm.proxy(Ham, bind=True)
+        (proxy + 0) | should.eq(1)
+        (proxy + 0) | should.eq(2)
+
     def test_proxy_support_contextual(self):
         self.cnt = 0
 
@@ -506,6 +1991,25 @@ class ContextualDependencyMapTests(unittest.TestCase):
         self.map.context('A')
         self.map['foo'] | should.eq('FOO')
 
+    def test_preload_for_fork_with_active_context(self):
+        built = []
+
+        @self.map.singleton('safe', fork_safe=True)
+        def safe(deps):
+            built.append(deps['lang'])
+            return {}
+
+        self.map['lang'] = 'root'
+        self.map.context('A')
+        self.map['lang'] = 'A'
+        self.map.preload_for_fork(freeze=False)
+        sorted(built) | should.eql(['A', 'root'])
+
+        self.map['safe']
+        self.map.context(None)
+        self.map['safe']
+        built | should.have_len(2)
+
     def test_factory_in_different_context(self):
         @self.map.factory('foo')
         def fn(deps):
@@ -564,6 +2068,34 @@ class ContextualDependencyMapTests(unittest.TestCase):
 
         test() | should.eql('ROOT')
 
+    def test_activate_is_local_to_thread(self):
+        import threading
+        self.map['foo'] = 'ROOT'
+        entered, exited = threading.Event(), threading.Event()
+        results = []
+
+        def worker():
+            with self.map.activate('B'):
+                self.map['foo'] = 'B'
+                entered.set()
+                exited.wait()
+                results.append(self.map['foo'])
+
+        t = threading.Thread(target=worker)
+        try:
+            with self.map.activate('A'):
+                self.map['foo'] = 'A'
+                t.start()
+                entered.wait()
+                self.map['foo'] | should.eq('A')
+        finally:
+            exited.set()
+            t.join()
+
+        results | should.eql(['B'])
+        self.map['foo'] | should.eq('ROOT')
+
+
 class PatchedDependencyMapTests(unittest.TestCase):
     """
     PatchedDependencyMap is mostly useful for testing with mocks
@@ -601,5 +2133,68 @@ class PatchedDependencyMapTests(unittest.TestCase):
         check_instance()
 
 
+PROFILED_MODULE = """
+from di import injector, DependencyMap
+
+class Config(object): pass
+
+dm = DependencyMap()
+dm.singleton(Config)(lambda deps: Config())
+inject = injector(dm)
+
+@inject
+def handler(request, config=Config):
+    return config
+"""
+
+
+class ProfileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        with open(os.path.join(self.path, 'di_profiled.py'), 'w') as fd:
+            fd.write(PROFILED_MODULE)
+        sys.path.insert(0, self.path)
+
+    def tearDown(self):
+        sys.path.remove(self.path)
+        sys.modules.pop('di_profiled', None)
+        shutil.rmtree(self.path)
+
+    def run_profile(self, *args):
+        import json
+        import di.profile
+        try:
+            from io import StringIO
+        except ImportError:
+            from StringIO import StringIO
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            di.profile.main(list(args) + ['--json'])
+            return json.loads(sys.stdout.getvalue())
+        finally:
+            sys.stdout = stdout
+
+    def test_report(self):
+        report = self.run_profile('di_profiled:dm')
+        report['imports']['items'][0]['name'] | should.eq('di_profiled')
+        report['decorations']['items'][0]['name'] | should.eq('di_profiled.handler')
+        report['inspections']['count'] | should.eq(1)
+        report['factories']['count'] | should.eq(0)
+
+    def test_warm(self):
+        report = self.run_profile('di_profiled:dm', '--warm')
+        report['factories']['items'][0]['name'] | should.eq('Config')
+
+    def test_restores_patched_functions(self):
+        self.run_profile('di_profiled')
+        di.injector | should.be(di.main.injector)
+        di.main.injector.__name__ | should.eq('injector')
+        di.main.get_callable_defaults.__module__ | should.eq('di.main')
+        DependencyMap._register.__module__ | should.eq('di.main')
+
+
 if __name__ == '__main__':
     unittest.main()